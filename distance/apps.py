@@ -4,3 +4,6 @@ from django.apps import AppConfig
 
 class DistanceConfig(AppConfig):
     name = 'distance'
+
+    def ready(self):
+        from . import checks, performance, signals
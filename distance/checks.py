@@ -0,0 +1,35 @@
+'''checks.py - System checks for settings the site relies on.'''
+from django.conf import settings
+from django.core import checks
+
+# cache backends that keep their entries inside each process
+PER_PROCESS_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+CACHED_SESSION_ENGINES = ('django.contrib.sessions.backends.cache',
+    'django.contrib.sessions.backends.cached_db')
+
+
+@checks.register()
+def check_shared_cache(app_configs, **kwargs):
+    '''Warns when the default cache, or the one sessions are cached in, is
+    kept per process, since what is in them must be the same in every
+    process.'''
+    warnings = []
+    if settings.CACHES['default']['BACKEND'] in PER_PROCESS_CACHES:
+        warnings.append(checks.Warning(
+            'The default cache is kept separately by each process.',
+            hint=('Version counters, the template fragments keyed on them, and '
+                'the friend ids that friend pages are authorized from are kept in it, so with more than one process, a change made through '
+                'one is not seen by the others. Use a shared cache such as memcached.'),
+            id='distance.W001',
+        ))
+    if (settings.SESSION_ENGINE in CACHED_SESSION_ENGINES
+            and settings.CACHES[settings.SESSION_CACHE_ALIAS]['BACKEND'] in PER_PROCESS_CACHES):
+        warnings.append(checks.Warning(
+            'Sessions are cached separately by each process.',
+            hint=('With more than one process, a session that was logged out '
+                'through one is still accepted by the others until it expires '
+                'from their caches. Use a shared cache such as memcached, or the '
+                'django.contrib.sessions.backends.db session engine.'),
+            id='distance.W002',
+        ))
+    return warnings
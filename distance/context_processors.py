@@ -0,0 +1,23 @@
+'''context_processors.py - Adds the data shown in the sidebar of every page to
+the template context.'''
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+
+def sidebar(request):
+    '''Adds the user's friends (friends_list), unread message count
+    (num_msgs), and whether it is pushed to them (push_enabled) to the
+    context. The friends are only fetched if a template
+    uses them, at most once per request, and with just the columns the
+    sidebar needs.'''
+    user = request.user
+    if not user.is_authenticated:
+        return {}
+    if not hasattr(request, '_sidebar_friends'):
+        request._sidebar_friends = SimpleLazyObject(
+            lambda: list(user.connections.only('id', 'username')))
+    return {
+        'friends_list': request._sidebar_friends,
+        'num_msgs': user.unread_count,
+        'push_enabled': settings.PUSH_ENABLED,
+    }
@@ -0,0 +1,53 @@
+'''fragments.py - Caches rendered pieces of templates (see the cachefragment
+tag in templatetags/fragment_cache.py). A fragment is keyed on the version
+counters of the data it shows, so a change to that data makes the next
+render miss instead of having to find and delete the old fragment. Hits and
+misses are counted per fragment so that the cache can be tuned.'''
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import versions
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def cache_key(name, vary_on):
+    '''Returns the cache key of a fragment. Values in vary_on that are
+    version counter keys are replaced by the counters' current values.'''
+    counter_keys = [value for value in vary_on if versions.is_key(value)]
+    counters = dict(zip(counter_keys, versions.get_many(counter_keys)))
+    parts = ['%s=%s' % (value, counters[value]) if value in counters else str(value)
+        for value in vary_on]
+    return 'fragment:%s:%s' % (name, hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest())
+
+def _count(name, outcome):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {'hits': 0, 'misses': 0})
+        stats[outcome] += 1
+
+def get_or_render(name, vary_on, render):
+    '''Returns the cached fragment, or calls render() and caches what it
+    returns for FRAGMENT_CACHE_TTL seconds.'''
+    key = cache_key(name, vary_on)
+    content = cache.get(key)
+    if content is None:
+        _count(name, 'misses')
+        content = render()
+        cache.set(key, content, settings.FRAGMENT_CACHE_TTL)
+    else:
+        _count(name, 'hits')
+    return content
+
+def snapshot():
+    '''Returns the hits, misses, and hit rate of every fragment so far.'''
+    with _stats_lock:
+        return dict((name, dict(stats, hit_rate=round(stats['hits'] /
+            float(stats['hits'] + stats['misses']), 3))) for name, stats in _stats.items())
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,55 @@
+'''friendships.py - Caches the ids of each user's friends so that checking
+whether two users are friends is a single cache hit instead of a query. The
+sets are kept in the shared cache (memcached, see CACHES), and dropped
+whenever connections change (see signals.py), so a removed friend loses
+access through every process at once.'''
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import replicas, versions
+from .models import User
+
+
+def cache_key(user_id):
+    return 'friends:%d' % user_id
+
+def friend_ids(user):
+    '''Returns a frozenset of the ids of the user's friends.'''
+    key = cache_key(user.pk)
+    ids = cache.get(key)
+    if ids is None:
+        # read from the primary, so that a replica that is behind cannot
+        # leave old connections cached
+        with replicas.use_primary():
+            ids = frozenset(User.connections.through.objects.filter(from_user_id=user.pk)
+                .values_list('to_user_id', flat=True))
+        cache.set(key, ids, settings.FRIENDS_CACHE_TTL)
+    return ids
+
+def is_friend(user, friend_id):
+    '''Returns whether the user is friends with the user with id friend_id.'''
+    try:
+        friend_id = int(friend_id)
+    except (TypeError, ValueError):
+        return False
+    return friend_id in friend_ids(user)
+
+def get_friend(user, friend_id):
+    '''Returns the user's friend with id friend_id, or None if they are not
+    friends. Only friends are fetched, by primary key.'''
+    if not is_friend(user, friend_id):
+        return None
+    return User.objects.filter(pk=friend_id).first()
+
+def invalidate(user_ids):
+    '''Drops the cached friends of the given users and bumps their friends'
+    version counters. The cache is dropped again once the current
+    transaction commits, so that a request that read the old connections in
+    the meantime cannot leave them cached.'''
+    user_ids = set(user_ids)
+    keys = [cache_key(user_id) for user_id in user_ids]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+        versions.bump(*[versions.friends_key(user_id) for user_id in user_ids])
@@ -0,0 +1,129 @@
+'''gazetteer.py - An offline reverse geocoder. Places from a GeoNames
+gazetteer (such as cities1000.txt from https://download.geonames.org/export/dump/)
+are loaded into a k-d tree stored in flat arrays, so that the place nearest
+to a latitude and longitude can be found in microseconds without calling
+Nominatim.'''
+from array import array
+import math
+import threading
+
+from django.conf import settings
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def to_xyz(lat, lng):
+    '''Converts a latitude and longitude to a point on the unit sphere, where
+    straight line distances grow with distances along the Earth.'''
+    lat = math.radians(lat)
+    lng = math.radians(lng)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+
+class KDTree:
+    '''A static 3-d tree over points on the unit sphere. The points are kept
+    in one flat array ordered so that the middle point of every range splits
+    it on axis (depth % 3), so the tree needs no node objects or pointers.
+    ids[i] is the caller's index of the i-th point in that order.'''
+    def __init__(self, points):
+        order = list(range(len(points)))
+        stack = [(0, len(order), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if hi - lo <= 1:
+                continue
+            order[lo:hi] = sorted(order[lo:hi], key=lambda i: points[i][axis])
+            mid = (lo + hi) // 2
+            stack.append((lo, mid, (axis + 1) % 3))
+            stack.append((mid + 1, hi, (axis + 1) % 3))
+        self.ids = array('l', order)
+        self.coords = array('d')
+        for i in order:
+            self.coords.extend(points[i])
+
+    def nearest(self, point):
+        '''Returns the id of the point nearest to point and the squared
+        straight line distance to it.'''
+        best_id = -1
+        best = float('inf')
+        coords = self.coords
+        stack = [(0, len(self.ids), 0, 0.0)]
+        while stack:
+            lo, hi, axis, bound = stack.pop()
+            # bound is how far the range is from the point along the axis that
+            # separates them; skip it if that is already too far
+            if lo >= hi or bound >= best:
+                continue
+            mid = (lo + hi) // 2
+            offset = mid * 3
+            dx = point[0] - coords[offset]
+            dy = point[1] - coords[offset + 1]
+            dz = point[2] - coords[offset + 2]
+            distance = dx * dx + dy * dy + dz * dz
+            if distance < best:
+                best_id, best = self.ids[mid], distance
+            diff = point[axis] - coords[offset + axis]
+            next_axis = (axis + 1) % 3
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            # visit the near side first so the far side can usually be skipped
+            stack.append((far[0], far[1], next_axis, diff * diff))
+            stack.append((near[0], near[1], next_axis, 0.0))
+        return best_id, best
+
+
+class Gazetteer:
+    '''Place names and their countries, indexed by location.'''
+    def __init__(self, path, countries_path=None):
+        countries = {}
+        if countries_path:
+            # countryInfo.txt: ISO code in the first column, name in the fifth
+            with open(countries_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith('#'):
+                        continue
+                    columns = line.rstrip('\n').split('\t')
+                    if len(columns) > 4:
+                        countries[columns[0]] = columns[4]
+        self.names = []
+        self.countries = []
+        points = []
+        # GeoNames dump: name, latitude, longitude, and country code in the
+        # second, fifth, sixth, and ninth columns
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                columns = line.rstrip('\n').split('\t')
+                if len(columns) < 9:
+                    continue
+                self.names.append(columns[1])
+                self.countries.append(countries.get(columns[8], columns[8]))
+                points.append(to_xyz(float(columns[4]), float(columns[5])))
+        self.tree = KDTree(points)
+
+    def reverse(self, lat, lng, max_km=None):
+        '''Returns the (city, country) of the place nearest to the given
+        coordinates, or None if there is none within max_km.'''
+        place, distance = self.tree.nearest(to_xyz(lat, lng))
+        if place < 0:
+            return None
+        if max_km is not None:
+            # convert the straight line distance to a distance along the Earth
+            km = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(distance) / 2))
+            if km > max_km:
+                return None
+        return (self.names[place], self.countries[place])
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    '''Returns the gazetteer at GAZETTEER_PATH, loading it on first use.'''
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            _gazetteer = Gazetteer(settings.GAZETTEER_PATH, settings.GAZETTEER_COUNTRIES_PATH)
+        return _gazetteer
@@ -0,0 +1,125 @@
+'''geocoding.py - Finds the city and country that users live in from their
+latitude and longitude. Lookups run on a background worker thread so that
+signing up never waits on the geocoder, and results are cached by location
+cell so that users who sign up near each other share one lookup.'''
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+
+from . import gazetteer, performance, replicas, versions
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+# shown as a user's city until their location has been looked up
+LOCATING = 'Locating…'
+NOT_FOUND = 'Not Found'
+# Nominatim names a place as a village, city, suburb, hamlet, or town based
+# on its size, so we must try them all
+CITY_KEYS = ('village', 'city', 'suburb', 'hamlet', 'town')
+
+
+def parse_address(address):
+    '''Returns the (city, country) in a Nominatim address.'''
+    city = NOT_FOUND
+    for key in CITY_KEYS:
+        if key in address:
+            city = address[key]
+            break
+    return (city, address.get('country', NOT_FOUND))
+
+def cell_for(lat, lng):
+    '''Rounds coordinates to the cell their lookup is cached under.'''
+    digits = settings.GEOCODE_CELL_DIGITS
+    return (round(float(lat), digits), round(float(lng), digits))
+
+def nominatim_reverse(lat, lng):
+    '''Asks Nominatim for the (city, country) at the given coordinates.'''
+    # geopy is slow to import, so only load it once it is needed
+    from geopy.geocoders import Nominatim
+    scheme, domain = settings.NOMINATIM_URL.split('://', 1)
+    with performance.timed('external'):
+        location = Nominatim(domain=domain, scheme=scheme).reverse('%s, %s' % (lat, lng))
+    return parse_address(location.raw['address'] if location else {})
+
+def offline_reverse(lat, lng):
+    '''Finds the (city, country) at the given coordinates in the local
+    gazetteer.'''
+    place = gazetteer.get_gazetteer().reverse(lat, lng, settings.GAZETTEER_MAX_KM)
+    return place or (NOT_FOUND, NOT_FOUND)
+
+def reverse_geocode(lat, lng):
+    '''Returns the (city, country) at the given coordinates using the
+    geocoder chosen by the GEOCODER setting. Nominatim is only asked if the
+    cell has not been looked up before.'''
+    if settings.GEOCODER == 'offline':
+        return offline_reverse(lat, lng)
+    cell = cell_for(lat, lng)
+    key = 'geocode:%s,%s' % cell
+    place = cache.get(key)
+    if place is None:
+        place = nominatim_reverse(*cell)
+        cache.set(key, place, settings.GEOCODE_CACHE_TTL)
+    return place
+
+
+# user ids waiting to be located, and the thread that locates them
+_jobs = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def locate(user_id):
+    '''Looks up a user's city and country and saves them, unless the user has
+    already set them another way.'''
+    # the user may have only just signed up, so a replica might not have them
+    with replicas.use_primary():
+        user = User.objects.filter(pk=user_id).values('lat', 'lng').first()
+    if user is None:
+        return
+    try:
+        city, country = reverse_geocode(user['lat'], user['lng'])
+    except Exception:
+        logger.exception('Could not locate user %s', user_id)
+        city, country = NOT_FOUND, NOT_FOUND
+    if User.objects.filter(pk=user_id, city=LOCATING).update(city=city, country=country):
+        versions.bump(versions.user_key(user_id))
+
+def _work():
+    while True:
+        user_id = _jobs.get()
+        # this thread's connection may have been dropped since the last job
+        close_old_connections()
+        try:
+            locate(user_id)
+        except Exception:
+            # keep the worker alive for the next job; locate_users finishes
+            # users whose lookup failed
+            logger.exception('Could not save the location of user %s', user_id)
+        finally:
+            close_old_connections()
+            _jobs.task_done()
+
+def locate_later(user_id):
+    '''Queues a user to be located on the background worker once the current
+    transaction commits.'''
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name='geocoding')
+            _worker.daemon = True
+            _worker.start()
+    transaction.on_commit(lambda: _jobs.put(user_id))
+
+def wait_for_jobs(timeout):
+    '''Waits up to timeout seconds for every queued user to be located, and
+    returns how many jobs are still unfinished.'''
+    deadline = time.time() + timeout
+    while _jobs.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.05)
+    return _jobs.unfinished_tasks
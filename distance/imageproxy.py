@@ -0,0 +1,318 @@
+'''imageproxy.py - Serves the background images users link to from this site,
+so that browsers do not download the full-size originals from third party
+hosts. Each url is fetched once and resized to the widths in
+PROXY_IMAGE_WIDTHS, as WebP and JPEG. Originals and resized copies are kept
+in a disk cache under PROXY_CACHE_DIR, named after a hash of the original's
+contents, and the least recently used files are removed once the cache grows
+past PROXY_CACHE_MAX_BYTES.
+
+Urls are only proxied if this site signed them (see proxied_url), so the
+proxy cannot be used to fetch arbitrary urls. Images are only fetched from
+public addresses, which are checked for every redirect and connected to
+directly, so that neither a redirect nor a second DNS lookup can point the
+proxy at the site's own network.'''
+import base64
+import functools
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+import threading
+from urllib.parse import urljoin, urlparse
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+
+from . import performance
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+ORIENTATION_TAG = 0x0112
+# EXIF orientations that rotate the photo by a quarter turn
+SIDEWAYS = (5, 6, 7, 8)
+REDIRECTS = (301, 302, 303, 307, 308)
+# the first bytes of the image formats browsers show, for serving originals
+# when Pillow is not installed
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+    (b'RIFF', 'image/webp'),
+)
+
+_signer = signing.Signer(salt='distance.imageproxy')
+# [lock, users] of the urls that are being fetched, so that concurrent
+# requests for the same url wait on one fetch instead of starting their own
+_url_locks = {}
+_url_locks_lock = threading.Lock()
+_evict_lock = threading.Lock()
+
+
+class ProxyError(Exception):
+    '''The image could not be fetched or read.'''
+
+
+@functools.lru_cache(maxsize=None)
+def pillow_installed():
+    '''Returns whether Pillow is installed. It is slow to import, so it is
+    only loaded once an image is shown or resized.'''
+    try:
+        import PIL.Image
+    except ImportError:
+        return False
+    return True
+
+@functools.lru_cache(maxsize=None)
+def webp_supported():
+    if not pillow_installed():
+        return False
+    from PIL import features
+    return features.check('webp')
+
+def sign(url):
+    '''Returns the token that stands for url in proxied image urls.'''
+    return _signer.sign(base64.urlsafe_b64encode(url.encode('utf-8')).decode('ascii').rstrip('='))
+
+def unsign(token):
+    '''Returns the url a token stands for, or None if this site did not sign
+    it.'''
+    try:
+        encoded = _signer.unsign(token)
+    except signing.BadSignature:
+        return None
+    return base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode('utf-8')
+
+def proxied_url(url, width, image_format):
+    return reverse('distance:proxied_image', args=(sign(url), width, image_format))
+
+
+def _path(*parts):
+    return os.path.join(settings.PROXY_CACHE_DIR, *parts)
+
+def _write(path, content):
+    # written to a temporary file first, so that readers never see part of it
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(descriptor, 'wb') as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+def _read(path):
+    '''Returns the contents of a cached file and marks it as just used, or
+    None if it is not cached.'''
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return content
+
+def evict():
+    '''Removes the least recently used files until the cache is under
+    PROXY_CACHE_MAX_BYTES again. Files are marked as used by setting their
+    modification time, since access times are often not kept.'''
+    with _evict_lock:
+        entries = []
+        total = 0
+        for directory, _, names in os.walk(settings.PROXY_CACHE_DIR):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+        if total <= settings.PROXY_CACHE_MAX_BYTES:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            # leave some room, so that the next few writes do not evict again
+            if total <= settings.PROXY_CACHE_MAX_BYTES * 0.9:
+                break
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    '''An HTTPConnection that connects to the address its host was checked
+    at, instead of looking the host up again (which could give another
+    address).'''
+    def __init__(self, host, address, **kwargs):
+        super(PinnedHTTPConnection, self).__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    '''PinnedHTTPConnection over TLS. The certificate is still checked
+    against the host's name.'''
+    def __init__(self, host, address, **kwargs):
+        self.tls_context = ssl.create_default_context()
+        super(PinnedHTTPSConnection, self).__init__(host, context=self.tls_context, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self.tls_context.wrap_socket(sock, server_hostname=self.host)
+
+
+def check_host(url):
+    '''Returns the parsed url and the address to connect to for it. Raises
+    ProxyError unless url is http(s) and every address its host has is
+    public (private addresses are allowed with PROXY_IMAGE_ALLOW_PRIVATE, for
+    local stand-ins).'''
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ProxyError('Not an http url: %s' % url)
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        addresses = [address[4][0] for address in
+            socket.getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)]
+    except (OSError, ValueError):
+        raise ProxyError('Cannot resolve %s' % parsed.hostname)
+    if not settings.PROXY_IMAGE_ALLOW_PRIVATE:
+        for address in addresses:
+            if not ipaddress.ip_address(address.split('%')[0]).is_global:
+                raise ProxyError('Not a public address: %s' % parsed.hostname)
+    return parsed, addresses[0]
+
+def get(url):
+    '''Sends a GET for url to the address check_host checked, and returns
+    the connection and its response. Redirects are not followed.'''
+    parsed, address = check_host(url)
+    connection_class = PinnedHTTPSConnection if parsed.scheme == 'https' else PinnedHTTPConnection
+    connection = connection_class(parsed.hostname, address, port=parsed.port,
+        timeout=settings.PROXY_IMAGE_TIMEOUT)
+    path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+    try:
+        connection.request('GET', path, headers={'User-Agent': 'hereandthere image proxy'})
+        return connection, connection.getresponse()
+    except Exception:
+        connection.close()
+        raise
+
+def fetch(url):
+    '''Downloads an image, refusing anything that is not an image or is over
+    PROXY_IMAGE_MAX_BYTES. Up to PROXY_IMAGE_MAX_REDIRECTS redirects are
+    followed, and every url on the way is checked with check_host.'''
+    location = url
+    try:
+        with performance.timed('external'):
+            for _ in range(settings.PROXY_IMAGE_MAX_REDIRECTS + 1):
+                connection, response = get(location)
+                try:
+                    if response.status in REDIRECTS and response.getheader('Location'):
+                        location = urljoin(location, response.getheader('Location'))
+                        continue
+                    if response.status != 200:
+                        raise ProxyError('Cannot fetch %s: status %d' % (url, response.status))
+                    if not (response.getheader('Content-Type') or '').startswith('image/'):
+                        raise ProxyError('Not an image: %s' % url)
+                    content = response.read(settings.PROXY_IMAGE_MAX_BYTES + 1)
+                    break
+                finally:
+                    connection.close()
+            else:
+                raise ProxyError('Too many redirects: %s' % url)
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        raise ProxyError('Cannot fetch %s: %s' % (url, e))
+    if len(content) > settings.PROXY_IMAGE_MAX_BYTES:
+        raise ProxyError('Image too large: %s' % url)
+    return content
+
+def original(url):
+    '''Returns the hash and contents of the original image at url, fetching
+    it only if it is not cached.'''
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    with _url_locks_lock:
+        entry = _url_locks.setdefault(url_hash, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            content_hash = _read(_path('urls', url_hash[:2], url_hash))
+            if content_hash is not None:
+                content_hash = content_hash.decode('ascii')
+                content = _read(_path('originals', content_hash[:2], content_hash))
+                if content is not None:
+                    return content_hash, content
+            content = fetch(url)
+            content_hash = hashlib.sha256(content).hexdigest()
+            _write(_path('originals', content_hash[:2], content_hash), content)
+            _write(_path('urls', url_hash[:2], url_hash), content_hash.encode('ascii'))
+    finally:
+        with _url_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _url_locks[url_hash]
+    evict()
+    return content_hash, content
+
+def resize(content, width, image_format):
+    '''Returns the image at most width pixels wide (it is never enlarged), in
+    image_format, without its metadata.'''
+    from PIL import Image as PILImage, ImageOps
+    try:
+        image = PILImage.open(io.BytesIO(content))
+        # JPEGs can be decoded at a fraction of their size, which is much
+        # faster than decoding them whole and shrinking them after. Photos
+        # whose EXIF orientation turns them sideways are shown height first.
+        if image.getexif().get(ORIENTATION_TAG, 1) in SIDEWAYS:
+            image.draft('RGB', (image.width * width // image.height, width))
+        else:
+            image.draft('RGB', (width, image.height * width // image.width))
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))),
+                PILImage.LANCZOS)
+        output = io.BytesIO()
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        image.save(output, image_format, quality=settings.PROXY_IMAGE_QUALITY,
+            optimize=True, progressive=True)
+    except (OSError, ValueError, SyntaxError, PILImage.DecompressionBombError) as e:
+        raise ProxyError('Cannot read image: %s' % e)
+    return output.getvalue()
+
+def sniff_type(content):
+    for signature, content_type in SIGNATURES:
+        if content.startswith(signature):
+            return content_type
+    return 'application/octet-stream'
+
+def variant(url, width, extension):
+    '''Returns the image at url resized to width in the format with the
+    given extension, as (name, content type, content), where the name is
+    unique to the content.
+
+    Without Pillow, images cannot be resized, so the original is returned
+    instead.'''
+    content_hash, content = original(url)
+    if not pillow_installed():
+        return content_hash, sniff_type(content), content
+    if extension == 'webp' and not webp_supported():
+        extension = 'jpg'
+    image_format, content_type = FORMATS[extension]
+    name = '%s-%d.%s' % (content_hash, width, extension)
+    path = _path('variants', content_hash[:2], name)
+    resized = _read(path)
+    if resized is None:
+        resized = resize(content, width, image_format)
+        _write(path, resized)
+        evict()
+    return name, content_type, resized
@@ -0,0 +1,96 @@
+'''inbox.py - Applies actions to many of a user's received messages at once.
+Each kind of action is one set-based query (or a few) no matter how many
+messages it is applied to, and all of them run in one transaction.'''
+import re
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import friendships
+from .models import User, Message
+
+ACCEPT = 'accept'
+REJECT = 'reject'
+DELETE = 'delete'
+READ = 'read'
+ACTIONS = (ACCEPT, REJECT, DELETE, READ)
+# only ASCII digits; str.isdigit() also accepts digits such as '²', which
+# int() rejects
+MESSAGE_ID = re.compile(r'[0-9]+')
+
+
+def message_id(text):
+    '''Returns the message id text is made of, or None if it is not one.'''
+    return int(text) if MESSAGE_ID.fullmatch(text) else None
+
+def parse_actions(data):
+    '''Returns the (message id, action) pairs in a POST. Either each message
+    is its own key with the action as its value, or one bulk action is
+    applied to every msg_id.'''
+    bulk = data.get('bulk')
+    if bulk:
+        pairs = [(msg_id, bulk) for msg_id in data.getlist('msg_id')]
+    else:
+        pairs = list(data.items())
+    return [(message_id(msg_id), action) for msg_id, action in pairs
+        if message_id(msg_id) is not None and action in ACTIONS]
+
+def _delete(user, ids):
+    '''Deletes the given received messages. They are marked read first with
+    one UPDATE, so that the unread count is lowered once instead of once per
+    message by the post_delete handler.'''
+    received = Message.objects.filter(receiver=user, pk__in=ids)
+    unread = received.filter(read=False).update(read=True, read_at=timezone.now())
+    User.change_unread_count(user.pk, -unread)
+    return received.delete()[0]
+
+def _befriend(user, sender_ids):
+    '''Connects user and each sender both ways, inserting only the rows that
+    do not exist yet.'''
+    through = User.connections.through
+    wanted = set()
+    for sender_id in sender_ids:
+        wanted.add((user.pk, sender_id))
+        wanted.add((sender_id, user.pk))
+    existing = set(through.objects.filter(
+        Q(from_user_id=user.pk, to_user_id__in=sender_ids) |
+        Q(from_user_id__in=sender_ids, to_user_id=user.pk))
+        .values_list('from_user_id', 'to_user_id'))
+    through.objects.bulk_create([through(from_user_id=from_id, to_user_id=to_id)
+        for from_id, to_id in sorted(wanted - existing)])
+    # bulk_create does not send m2m_changed
+    friendships.invalidate([user.pk] + list(sender_ids))
+
+def apply_actions(user, pairs):
+    '''Applies (message id, action) pairs to the messages user has received.
+    Messages that are not theirs are ignored, as are accepts and rejects of
+    messages that are not friend requests. Returns a dict with the usernames
+    that were added as friends ('accepted') and the number of messages that
+    were rejected, deleted, and read.'''
+    ids = {action: set() for action in ACTIONS}
+    for msg_id, action in pairs:
+        ids[action].add(msg_id)
+    result = {'accepted': [], REJECT: 0, DELETE: 0, READ: 0}
+    with transaction.atomic():
+        if ids[ACCEPT]:
+            requests = list(Message.objects
+                .filter(receiver=user, pk__in=ids[ACCEPT], msg_type=Message.FRIEND_REQUEST)
+                .values_list('pk', 'sender_id', 'sender__username'))
+            senders = dict((sender_id, username) for pk, sender_id, username in requests)
+            if senders:
+                _befriend(user, list(senders))
+                _delete(user, [pk for pk, sender_id, username in requests])
+            result['accepted'] = sorted(senders.values())
+        if ids[REJECT]:
+            rejected = (Message.objects.filter(receiver=user, pk__in=ids[REJECT],
+                msg_type=Message.FRIEND_REQUEST).values_list('pk', flat=True))
+            result[REJECT] = _delete(user, list(rejected))
+        if ids[DELETE]:
+            result[DELETE] = _delete(user, ids[DELETE])
+        if ids[READ]:
+            count = Message.objects.filter(receiver=user, pk__in=ids[READ],
+                read=False).update(read=True, read_at=timezone.now())
+            User.change_unread_count(user.pk, -count)
+            result[READ] = count
+    return result
@@ -0,0 +1,46 @@
+'''bench_geocoder.py - Compares the offline gazetteer with Nominatim.'''
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from distance import gazetteer, geocoding
+
+
+class Command(BaseCommand):
+    help = ('Times reverse geocoding random coordinates with the offline '
+        'gazetteer and with Nominatim (including parsing its address).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lookups', type=int, default=100000,
+            help='Offline lookups to time.')
+        parser.add_argument('--nominatim', type=int, default=5,
+            help='Nominatim lookups to time (keep this low for the public server).')
+
+    def random_coords(self, count):
+        return [(random.uniform(-60, 70), random.uniform(-180, 180)) for i in range(count)]
+
+    def handle(self, *args, **options):
+        started = time.time()
+        places = gazetteer.get_gazetteer()
+        self.stdout.write('Loaded %d places from %s in %.2fs.' % (len(places.names),
+            settings.GAZETTEER_PATH, time.time() - started))
+
+        coords = self.random_coords(options['lookups'])
+        started = time.time()
+        for lat, lng in coords:
+            places.reverse(lat, lng, settings.GAZETTEER_MAX_KM)
+        elapsed = time.time() - started
+        self.stdout.write('offline: %d lookups, %.1f us per lookup' % (len(coords),
+            elapsed / len(coords) * 1e6))
+
+        coords = self.random_coords(options['nominatim'])
+        if not coords:
+            return
+        started = time.time()
+        for lat, lng in coords:
+            geocoding.nominatim_reverse(lat, lng)
+        elapsed = time.time() - started
+        self.stdout.write('nominatim: %d lookups, %.1f us per lookup' % (len(coords),
+            elapsed / len(coords) * 1e6))
@@ -0,0 +1,87 @@
+'''bench_message_indexes.py - Shows the query plans and timings of the hot
+Message queries with and without their composite indexes.'''
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from distance import replicas
+from distance.models import User, Message
+
+
+class Command(BaseCommand):
+    help = ('Seeds a large message table in a throwaway test database and prints '
+        'the query plans and timings of the hot Message queries without and '
+        'with their composite indexes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--messages', type=int, default=200000)
+        parser.add_argument('--repeat', type=int, default=200,
+            help='Times to run each query.')
+
+    def handle(self, *args, **options):
+        # never seed the real database
+        old_name = connection.creation.create_test_db(verbosity=0)
+        # only the default database is replaced, so read from it
+        replicas.pin()
+        try:
+            self.seed(options['users'], options['messages'])
+            index_together = Message._meta.index_together
+            with connection.schema_editor() as editor:
+                editor.alter_index_together(Message, index_together, [])
+            self.stdout.write('== Without composite indexes')
+            self.run_queries(options['repeat'])
+            with connection.schema_editor() as editor:
+                editor.alter_index_together(Message, [], index_together)
+            self.stdout.write('== With composite indexes')
+            self.run_queries(options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, num_users, num_messages):
+        User.objects.bulk_create([User(username='bench%d' % i, password='!', timezone='UTC')
+            for i in range(num_users)])
+        self.user_ids = list(User.objects.values_list('id', flat=True))
+        now = timezone.now()
+        batch = []
+        for i in range(num_messages):
+            sender_id, receiver_id = random.sample(self.user_ids, 2)
+            batch.append(Message(sender_id=sender_id, receiver_id=receiver_id,
+                msg_content='Hello', created_at=now,
+                msg_type=Message.FRIEND_REQUEST if random.random() < 0.1 else Message.NORMAL_MESSAGE,
+                read=random.random() < 0.7))
+            if len(batch) == 1000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+        self.stdout.write('Seeded %d users and %d messages on %s.' % (num_users, num_messages, connection.vendor))
+
+    def queries(self, user_id, friend_id):
+        return [
+            ('unread messages', Message.objects.filter(receiver_id=user_id, read=False)),
+            ('conversation', Message.objects.filter(receiver_id=user_id, sender_id=friend_id)),
+            ('pending request', Message.objects.filter(sender_id=user_id, receiver_id=friend_id,
+                msg_type=Message.FRIEND_REQUEST)),
+        ]
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+
+    def run_queries(self, repeat):
+        pairs = [random.sample(self.user_ids, 2) for i in range(repeat)]
+        for i, (name, queryset) in enumerate(self.queries(*pairs[0])):
+            self.stdout.write('%s:' % name)
+            for line in self.explain(queryset):
+                self.stdout.write('    ' + line)
+            started = time.time()
+            for user_id, friend_id in pairs:
+                list(self.queries(user_id, friend_id)[i][1])
+            elapsed = (time.time() - started) / repeat
+            self.stdout.write('    %.3f ms per query' % (elapsed * 1000))
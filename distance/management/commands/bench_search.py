@@ -0,0 +1,84 @@
+'''bench_search.py - Measures friend search latency on a large user table.'''
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connection
+
+from distance import replicas
+from distance.models import User, UsernameTrigram
+from distance.search import search_users
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'to', 'ne', 'su', 'vi', 'da', 'el', 'an', 'or',
+    'be', 'ch', 'is', 'qu', 'ze', 'fo', 'gu', 'hy']
+
+
+def random_username():
+    return ''.join(random.choice(SYLLABLES) for i in range(random.randint(3, 5))) + str(random.randint(0, 99))
+
+def with_typo(username):
+    '''Swaps two neighbouring letters, like a typing mistake.'''
+    i = random.randint(0, len(username) - 2)
+    return username[:i] + username[i + 1] + username[i] + username[i + 2:]
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throwaway test database with many users and measures the '
+        'latency of exact, prefix, and misspelled friend searches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000)
+        parser.add_argument('--searches', type=int, default=50,
+            help='Searches of each kind to time.')
+
+    def handle(self, *args, **options):
+        # never seed the real database
+        old_name = connection.creation.create_test_db(verbosity=0)
+        # only the default database is replaced, so read from it
+        replicas.pin()
+        try:
+            self.seed(options['users'])
+            searcher = User.objects.order_by('pk')[0]
+            usernames = list(User.objects.order_by('?').values_list('username', flat=True)[:options['searches']])
+            kinds = [
+                ('exact', usernames),
+                ('prefix', [username[:4] for username in usernames]),
+                ('typo', [with_typo(username) for username in usernames]),
+            ]
+            for kind, queries in kinds:
+                times = []
+                for query in queries:
+                    started = time.time()
+                    page = Paginator(search_users(searcher, query), settings.SEARCH_PAGE_SIZE).page(1)
+                    list(page)
+                    times.append(time.time() - started)
+                times.sort()
+                self.stdout.write('%s: median %.1f ms, p95 %.1f ms over %d searches' % (kind,
+                    times[len(times) // 2] * 1000, times[int(len(times) * 0.95)] * 1000, len(times)))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, num_users):
+        started = time.time()
+        seen = set()
+        batch = []
+        while len(seen) < num_users:
+            username = random_username()
+            if username in seen:
+                continue
+            seen.add(username)
+            batch.append(User(username=username, password='!', timezone='UTC'))
+            if len(batch) == 10000:
+                self.save_users(batch)
+                batch = []
+        self.save_users(batch)
+        self.stdout.write('Seeded %d users on %s in %.0fs.' % (num_users, connection.vendor,
+            time.time() - started))
+
+    def save_users(self, users):
+        # bulk_create does not send post_save, so index the usernames here
+        User.objects.bulk_create(users)
+        UsernameTrigram.index_users(User.objects.filter(
+            username__in=[user.username for user in users]).only('id', 'username'))
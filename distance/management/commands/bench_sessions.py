@@ -0,0 +1,118 @@
+'''bench_sessions.py - Counts the database queries and writes per request,
+and how many of them are for sessions, with the session engine and message
+storage in settings and with Django's defaults.'''
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from distance.models import User
+
+CONFIGURATIONS = [
+    ('Django defaults', {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        'MESSAGE_STORAGE': 'django.contrib.messages.storage.fallback.FallbackStorage',
+    }),
+    ('Messages in the session', {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        'MESSAGE_STORAGE': 'django.contrib.messages.storage.session.SessionStorage',
+    }),
+    ('Settings', {
+        'SESSION_ENGINE': settings.SESSION_ENGINE,
+        'MESSAGE_STORAGE': settings.MESSAGE_STORAGE,
+    }),
+]
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+# sessions are cached here rather than in the shared cache, which the
+# throwaway database's sessions must not reach and which is never cleared
+BENCH_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'bench_sessions'}}
+
+
+class Command(BaseCommand):
+    help = ('Walks a few users through the site in a throwaway test database '
+        'and prints the queries, writes, and session queries per request with '
+        'Django\'s default session engine and message storage, with messages '
+        'kept in the session, and with the ones in settings.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        # never seed the real database
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            users = self.seed(options['users'])
+            for name, config in CONFIGURATIONS:
+                # only the default database was replaced, so read from it
+                with override_settings(DATABASE_REPLICAS=[], CACHES=BENCH_CACHES, **config):
+                    caches[settings.SESSION_CACHE_ALIAS].clear()
+                    self.stdout.write('== %s (%s, %s)' % (name, config['SESSION_ENGINE'].rsplit('.', 1)[1],
+                        config['MESSAGE_STORAGE'].rsplit('.', 1)[1]))
+                    self.report(self.walk(users))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def seed(self, num_users):
+        users = [User.objects.create_user('bench%d' % i, '', 'bench-password', timezone='UTC',
+            lat=41.88, lng=-87.63) for i in range(num_users)]
+        for user, friend in zip(users, users[1:] + users[:1]):
+            user.connections.add(friend)
+            friend.connections.add(user)
+        return users
+
+    def steps(self, user):
+        '''The requests of one visit, as (name, method, path, data). Each POST
+        redirects, and the redirect is followed as its own request.'''
+        friend = user.connections.first()
+        stranger = random.choice(User.objects.exclude(pk=user.pk).exclude(pk=friend.pk))
+        return [
+            ('home', 'get', reverse('distance:index'), {}),
+            ('friend view', 'get', reverse('distance:friend_view', args=(friend.pk,)), {}),
+            ('send message', 'post', reverse('distance:send_msg_f', args=(friend.pk,)), {'msg': 'Hello'}),
+            ('add image', 'post', reverse('distance:image_confirm', args=(friend.pk,)),
+                {'image_url': 'https://example.com/%d.jpg' % random.randint(0, 10 ** 9)}),
+            ('add friend', 'post', reverse('distance:add_friend'), {'friend_result': stranger.username}),
+            ('messages', 'get', reverse('distance:view_messages'), {}),
+            ('settings', 'get', reverse('distance:settings_view'), {}),
+        ]
+
+    def walk(self, users):
+        '''Sends every user's visit and returns [requests, queries, writes,
+        session queries] totals per step name.'''
+        totals = {}
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            for name, method, path, data in self.steps(user):
+                while path:
+                    with CaptureQueriesContext(connection) as context:
+                        response = getattr(client, method)(path, data, secure=True)
+                    sql = [query['sql'] for query in context.captured_queries]
+                    counts = totals.setdefault(name, [0, 0, 0, 0])
+                    counts[0] += 1
+                    counts[1] += len(sql)
+                    counts[2] += sum(1 for query in sql if query.lstrip().upper().startswith(WRITES))
+                    counts[3] += sum(1 for query in sql if 'django_session' in query)
+                    # follow the redirect as the next request of this step
+                    path = response.url if response.status_code == 302 and method == 'post' else None
+                    if path:
+                        name, method, data = name + ' (redirect)', 'get', {}
+        return totals
+
+    def report(self, totals):
+        self.stdout.write('    %-26s %8s %8s %8s' % ('request', 'queries', 'writes', 'session'))
+        overall = [0, 0, 0, 0]
+        for name, (requests, queries, writes, session) in totals.items():
+            self.stdout.write('    %-26s %8.1f %8.1f %8.1f' % (name, queries / float(requests),
+                writes / float(requests), session / float(requests)))
+            overall = [total + count for total, count in zip(overall, (requests, queries, writes, session))]
+        self.stdout.write('    %-26s %8.1f %8.1f %8.1f' % ('per request', overall[1] / float(overall[0]),
+            overall[2] / float(overall[0]), overall[3] / float(overall[0])))
@@ -0,0 +1,52 @@
+'''bench_startup.py - Measures how long a fresh WSGI worker takes to start.'''
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# what a new worker does before it can answer its first request
+STARTUP = '''
+import mysite.wsgi
+from django.urls import get_resolver
+get_resolver().url_patterns
+'''
+
+
+class Command(BaseCommand):
+    help = ('Measures the cold start of a WSGI worker (importing mysite.wsgi '
+        'and loading the URLconf) in fresh Python processes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=10)
+        parser.add_argument('--top', type=int, default=0,
+            help='Also list the TOP slowest imports (Python 3.7 and later).')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', 'mysite.settings'))
+        times = []
+        for i in range(options['runs']):
+            started = time.time()
+            subprocess.check_call([sys.executable, '-c', STARTUP], cwd=settings.BASE_DIR, env=env)
+            times.append(time.time() - started)
+        times.sort()
+        self.stdout.write('Worker startup over %d runs: min %.0f ms, median %.0f ms, max %.0f ms' % (
+            len(times), times[0] * 1000, times[len(times) // 2] * 1000, times[-1] * 1000))
+
+        if options['top']:
+            output = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP],
+                cwd=settings.BASE_DIR, env=env, stderr=subprocess.PIPE,
+                universal_newlines=True).stderr
+            imports = []
+            for line in output.splitlines():
+                if line.startswith('import time:') and '|' in line:
+                    columns = line[len('import time:'):].split('|')
+                    if columns[1].strip().isdigit():
+                        imports.append((int(columns[1]), columns[2].strip()))
+            imports.sort(reverse=True)
+            self.stdout.write('Slowest imports (cumulative):')
+            for microseconds, name in imports[:options['top']]:
+                self.stdout.write('    %7.1f ms  %s' % (microseconds / 1000, name))
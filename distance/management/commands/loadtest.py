@@ -0,0 +1,404 @@
+'''loadtest.py - Drives every page of the site with concurrent clients against
+seeded data and stand-ins for the external services, and reports latency,
+throughput, and query counts per page as JSON.'''
+import cProfile
+import itertools
+import json
+import math
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from distance import geocoding, imageproxy, profiling, stubs, urls, weather
+from distance.models import User, Message, Image, UsernameTrigram
+
+PASSWORD = 'loadtest-password'
+TIMEZONES = ['America/Chicago', 'America/New_York', 'Europe/London', 'Europe/Paris',
+    'Asia/Tokyo', 'Australia/Sydney', 'UTC']
+# users are placed around these cities so that many share weather cells
+CENTERS = [(41.88, -87.63), (40.71, -74.01), (51.51, -0.13), (48.86, 2.35),
+    (35.68, 139.69), (-33.87, 151.21)]
+
+
+def percentile(values, p):
+    '''Returns the nearest-rank p-th percentile of sorted values.'''
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class Scenarios:
+    '''Builds one request for each named url. Each method is given the worker's
+    user and returns (method, path, data); anything the request needs (such
+    as a friend request to accept) is created first, outside the timing.'''
+    # urls that are requested by a new, logged out client every time
+    anonymous = ('signup',)
+    # urls that are requested by a staff user
+    staff = ('performance', 'profiles', 'profile_detail')
+
+    def __init__(self, users, image_urls):
+        self.users = users
+        self.image_urls = image_urls
+        self.usernames = [user.username for user in users]
+        self.signups = itertools.count()
+
+    def friend_of(self, user):
+        friend_id = random.choice(list(User.connections.through.objects
+            .filter(from_user_id=user.pk).values_list('to_user_id', flat=True)) or [None])
+        if friend_id is None:
+            friend = random.choice(self.users)
+            user.connections.add(friend)
+            friend.connections.add(user)
+            friend_id = friend.pk
+        return User.objects.get(pk=friend_id)
+
+    def stranger(self, user):
+        return random.choice([other for other in random.sample(self.users, 3) if other.pk != user.pk])
+
+    def index(self, user):
+        return ('get', reverse('distance:index'), {})
+
+    def signup(self, user):
+        username = 'signup%d_%d' % (user.pk, next(self.signups))
+        lat, lng = random.choice(CENTERS)
+        return ('post', reverse('distance:signup'), {'username': username,
+            'email': username + '@example.com', 'password1': PASSWORD, 'password2': PASSWORD,
+            'timezone': random.choice(TIMEZONES), 'lat': lat, 'lng': lng})
+
+    def search_friends(self, user):
+        return ('get', reverse('distance:search_friends'),
+            {'search_friends': random.choice(self.usernames)[:6]})
+
+    def add_friend(self, user):
+        return ('post', reverse('distance:add_friend'),
+            {'friend_result': self.stranger(user).username})
+
+    def view_messages(self, user):
+        return ('get', reverse('distance:view_messages'), {})
+
+    def accept(self, user):
+        msg = Message(sender=self.stranger(user), receiver=user, msg_content='Be my friend',
+            created_at=timezone.now(), msg_type=Message.FRIEND_REQUEST)
+        msg.save()
+        return ('post', reverse('distance:accept'), {str(msg.id): 'Accept'})
+
+    def inbox_action(self, user):
+        sender = self.stranger(user)
+        msgs = [Message(sender=sender, receiver=user, msg_content='Hello',
+            created_at=timezone.now()) for i in range(10)]
+        for msg in msgs:
+            msg.save()
+        return ('post', reverse('distance:inbox_action'),
+            {'bulk': 'delete', 'msg_id': [str(msg.id) for msg in msgs]})
+
+    def events(self, user):
+        # the test client does not read the stream, so this times opening it
+        return ('get', reverse('distance:events'), {})
+
+    def friends(self, user):
+        return ('get', reverse('distance:friends'), {})
+
+    def friend_view(self, user):
+        return ('get', reverse('distance:friend_view', args=(self.friend_of(user).id,)), {})
+
+    def friend_data(self, user):
+        return ('get', reverse('distance:friend_data', args=(self.friend_of(user).id,)), {})
+
+    def add_images(self, user):
+        return ('get', reverse('distance:add_images', args=(self.friend_of(user).id,)), {})
+
+    def image_confirm(self, user):
+        return ('post', reverse('distance:image_confirm', args=(self.friend_of(user).id,)),
+            {'image_url': 'https://example.com/%d.jpg' % random.randint(0, 10 ** 9)})
+
+    def proxied_image(self, user):
+        # a few images at random widths, so that most requests are cache hits
+        return ('get', imageproxy.proxied_url(random.choice(self.image_urls),
+            random.choice(settings.PROXY_IMAGE_WIDTHS), random.choice(('webp', 'jpg'))), {})
+
+    def send_msg(self, user):
+        return ('post', reverse('distance:send_msg'),
+            {'receiver': self.friend_of(user).username, 'msg': 'Hello'})
+
+    def send_msg_f(self, user):
+        return ('post', reverse('distance:send_msg_f', args=(self.friend_of(user).id,)), {'msg': 'Hello'})
+
+    def del_img(self, user):
+        friend = self.friend_of(user)
+        image = Image(user1=user, user2=friend,
+            image_url='https://example.com/%d.jpg' % random.randint(0, 10 ** 9))
+        image.save()
+        return ('post', reverse('distance:del_img', args=(friend.id,)), {image.image_url: 'X'})
+
+    def del_friend(self, user):
+        friend = self.stranger(user)
+        user.connections.add(friend)
+        return ('post', reverse('distance:del_friend'), {str(friend.id): 'X'})
+
+    def settings_view(self, user):
+        return ('get', reverse('distance:settings_view'), {})
+
+    def settings_set(self, user):
+        return ('post', reverse('distance:settings_set'), {'timezone': user.timezone,
+            'lat': user.lat, 'lng': user.lng, 'temp_unit': random.choice('KCF'),
+            'city': user.city, 'country': user.country})
+
+    def performance(self, user):
+        return ('get', reverse('distance:performance'), {})
+
+    def profiles(self, user):
+        return ('get', reverse('distance:profiles'), {})
+
+    def profile_detail(self, user):
+        saved = profiling.list_profiles()
+        if saved:
+            name = saved[0]['name']
+        else:
+            profiler = cProfile.Profile()
+            profiler.runcall(self.users[0].get_full_name)
+            name = profiling.save(profiler, 'loadtest')
+        return ('get', reverse('distance:profile_detail', args=(name,)), {})
+
+    def get(self, name):
+        return getattr(self, name, None)
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throwaway test database, replaces OpenWeatherMap, '
+        'Nominatim, and image hosts with local stand-ins, drives every url in '
+        'distance/urls.py with concurrent clients, and prints p50/p95/p99 '
+        'latency, throughput, and query counts per url as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--friends', type=int, default=10,
+            help='Friends per seeded user.')
+        parser.add_argument('--messages', type=int, default=20,
+            help='Messages received per seeded user.')
+        parser.add_argument('--images', type=int, default=2,
+            help='Background images per friendship.')
+        parser.add_argument('--concurrency', type=int, default=8,
+            help='Clients sending requests at the same time.')
+        parser.add_argument('--requests', type=int, default=200,
+            help='Timed requests per url.')
+        parser.add_argument('--latency', type=float, default=0.05,
+            help='Seconds the stand-in services wait before answering.')
+        parser.add_argument('--fetch-on-miss', action='store_true',
+            help='Fetch weather on page views instead of refreshing it beforehand.')
+        parser.add_argument('--only', nargs='*', default=None,
+            help='Only drive these url names.')
+        parser.add_argument('--geocoding-timeout', type=float, default=30,
+            help='Seconds to wait for queued signups to be located before reporting.')
+        parser.add_argument('--output', default=None,
+            help='Write the JSON report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        weather_server = stubs.start(stubs.WeatherStubHandler, latency=options['latency'])
+        nominatim_server = stubs.start(stubs.NominatimStubHandler, latency=options['latency'])
+        image_server = stubs.start(stubs.ImageStubHandler, latency=options['latency'])
+        profile_dir = tempfile.mkdtemp()
+        static_root = tempfile.mkdtemp()
+        image_cache = tempfile.mkdtemp()
+        setup_test_environment()
+        # never seed the real database
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            with override_settings(WEATHER_API_URL=weather_server.url + '/data/2.5',
+                    NOMINATIM_URL=nominatim_server.url, GEOCODER='nominatim', PROFILE_DIR=profile_dir,
+                    STATIC_ROOT=static_root, PROXY_CACHE_DIR=image_cache, PROXY_IMAGE_ALLOW_PRIVATE=True,
+                    DATABASE_REPLICAS=[],
+                    # the test database reuses the real database's ids, so
+                    # keep what is cached about them out of the shared cache
+                    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                        'LOCATION': 'loadtest'}},
+                    WEATHER_FETCH_ON_MISS=options['fetch_on_miss']):
+                weather.cache.clear()
+                # pages link to the hashed names in the static files manifest
+                call_command('collectstatic', interactive=False, verbosity=0)
+                seeded = self.seed(options, image_server.url)
+                if not options['fetch_on_miss']:
+                    cells = set(weather.cell_for(user.lat, user.lng) for user in seeded['users'])
+                    observations = weather.refresh_cells(cells)[0]
+                    weather.store_reports(observations, timezone.now())
+                scenarios = Scenarios(seeded['users'],
+                    list(Image.objects.values_list('image_url', flat=True)[:3]))
+                report = {'config': dict((key, options[key]) for key in ('users', 'friends',
+                    'messages', 'images', 'concurrency', 'requests', 'latency', 'fetch_on_miss')),
+                    'database': connection.vendor, 'seed_seconds': seeded['seconds'],
+                    'urls': {}, 'skipped': []}
+                for pattern in urls.urlpatterns:
+                    name = pattern.name
+                    if options['only'] is not None and name not in options['only']:
+                        continue
+                    scenario = scenarios.get(name)
+                    if scenario is None:
+                        # a url was added without a scenario; say so rather
+                        # than silently leaving it out of the report
+                        report['skipped'].append(name)
+                        continue
+                    users = [seeded['staff']] if name in scenarios.staff else seeded['users']
+                    report['urls'][name] = self.drive(scenario, name in scenarios.anonymous,
+                        users, options['concurrency'], options['requests'])
+                # signups that were never located count as errors rather
+                # than leaving the command waiting on them forever
+                report['geocoding_errors'] = geocoding.wait_for_jobs(options['geocoding_timeout'])
+                if report['geocoding_errors']:
+                    self.stderr.write('%d signups were not located within %ss.' % (
+                        report['geocoding_errors'], options['geocoding_timeout']))
+                report['upstream_requests'] = {
+                    'weather': weather_server.requests, 'nominatim': nominatim_server.requests,
+                    'images': image_server.requests}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            shutil.rmtree(static_root, ignore_errors=True)
+            shutil.rmtree(image_cache, ignore_errors=True)
+            weather_server.shutdown()
+            nominatim_server.shutdown()
+            image_server.shutdown()
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def seed(self, options, image_host):
+        '''Creates users with friends, messages, and images using bulk_create.'''
+        started = time.time()
+        password = make_password(PASSWORD)
+        users = []
+        for i in range(options['users']):
+            lat, lng = random.choice(CENTERS)
+            users.append(User(username='load%06d' % i, password=password,
+                timezone=random.choice(TIMEZONES), lat=lat + random.uniform(-0.5, 0.5),
+                lng=lng + random.uniform(-0.5, 0.5), city='Seeded', country='Seedland',
+                unread_count=options['messages']))
+        User.objects.bulk_create(users, batch_size=500)
+        users = list(User.objects.filter(username__startswith='load').order_by('pk'))
+        UsernameTrigram.index_users(users)
+
+        through = User.connections.through
+        pairs = set()
+        for user in users:
+            for friend in random.sample(users, min(options['friends'], len(users))):
+                if friend.pk != user.pk:
+                    pairs.add((user.pk, friend.pk))
+                    pairs.add((friend.pk, user.pk))
+        through.objects.bulk_create([through(from_user_id=from_id, to_user_id=to_id)
+            for from_id, to_id in pairs], batch_size=500)
+
+        now = timezone.now()
+        msgs = []
+        images = []
+        for user in users:
+            for i in range(options['messages']):
+                msgs.append(Message(sender=random.choice(users), receiver=user,
+                    msg_content='Seeded message %d' % i, created_at=now,
+                    msg_type=random.choice([Message.NORMAL_MESSAGE] * 9 + [Message.FRIEND_REQUEST])))
+        for from_id, to_id in pairs:
+            if from_id < to_id:
+                for i in range(options['images']):
+                    # bulk_create skips save(), so fill in the sorted pair here
+                    images.append(Image(user1_id=from_id, user2_id=to_id, low_user_id=from_id,
+                        high_user_id=to_id, image_url='%s/%d-%d-%d.jpg' % (image_host, from_id, to_id, i)))
+        Message.objects.bulk_create(msgs, batch_size=500)
+        Image.objects.bulk_create(images, batch_size=500)
+        staff = User.objects.create(username='loadstaff', password=password, timezone='UTC',
+            is_staff=True)
+        return {'users': users, 'staff': staff, 'seconds': round(time.time() - started, 2)}
+
+    def drive(self, scenario, anonymous, users, concurrency, num_requests):
+        '''Sends num_requests requests built by scenario from concurrency
+        threads, each logged in as a different user (or logged out, for
+        anonymous urls), after one untimed request each to warm up. Returns
+        the url's statistics.'''
+        timings = []
+        # when the first timed request started and the last one ended
+        window = [float('inf'), 0]
+        queries = []
+        errors = []
+        lock = threading.Lock()
+        start = threading.Barrier(concurrency + 1)
+        counts = [num_requests // concurrency + (1 if i < num_requests % concurrency else 0)
+            for i in range(concurrency)]
+
+        def record(began, elapsed, num_queries, error):
+            with lock:
+                if elapsed is not None:
+                    timings.append(elapsed)
+                    queries.append(num_queries)
+                    window[0] = min(window[0], began)
+                    window[1] = max(window[1], began + elapsed)
+                if error is not None:
+                    errors.append(error)
+
+        def work(user, count):
+            client = Client()
+            try:
+                if not anonymous:
+                    client.force_login(user)
+                self.send(client, scenario(user))
+            except Exception as e:
+                record(None, None, 0, repr(e))
+            start.wait()
+            try:
+                for i in range(count):
+                    error = None
+                    try:
+                        request = scenario(user)
+                    except Exception as e:
+                        record(None, None, 0, repr(e))
+                        continue
+                    if anonymous:
+                        client = Client()
+                    with CaptureQueriesContext(connection) as context:
+                        began = time.time()
+                        try:
+                            response = self.send(client, request)
+                            if response.status_code >= 500:
+                                error = 'status %d' % response.status_code
+                        except Exception as e:
+                            error = repr(e)
+                        elapsed = time.time() - began
+                    record(began, elapsed, len(context.captured_queries), error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work, args=(users[i % len(users)], counts[i]))
+            for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        for thread in threads:
+            thread.join()
+        timings.sort()
+        if not timings:
+            return {'requests': 0, 'errors': len(errors), 'first_error': errors[0] if errors else None}
+        return {
+            'requests': len(timings),
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'p50_ms': round(percentile(timings, 50) * 1000, 2),
+            'p95_ms': round(percentile(timings, 95) * 1000, 2),
+            'p99_ms': round(percentile(timings, 99) * 1000, 2),
+            'throughput_rps': round(len(timings) / (window[1] - window[0]), 1),
+            'queries_mean': round(sum(queries) / float(len(queries)), 2),
+            'queries_max': max(queries),
+        }
+
+    def send(self, client, request):
+        method, path, data = request
+        # the site redirects plain http to https
+        return getattr(client, method)(path, data, secure=True)
@@ -0,0 +1,17 @@
+'''locate_users.py - Looks up the city and country of users whose background
+lookup never finished.'''
+from django.core.management.base import BaseCommand
+
+from distance import geocoding
+from distance.models import User
+
+
+class Command(BaseCommand):
+    help = ('Looks up the city and country of users still shown as locating, '
+        'such as those whose lookup was lost when a worker restarted.')
+
+    def handle(self, *args, **options):
+        user_ids = list(User.objects.filter(city=geocoding.LOCATING).values_list('id', flat=True))
+        for user_id in user_ids:
+            geocoding.locate(user_id)
+        self.stdout.write('Located %d users.' % len(user_ids))
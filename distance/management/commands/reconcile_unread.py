@@ -0,0 +1,54 @@
+'''reconcile_unread.py - Repairs users' unread message counts.'''
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from distance.models import User, Message
+
+
+class Command(BaseCommand):
+    help = 'Recounts every user\'s unread messages and repairs counts that have drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+            help='Only report the counts that have drifted.')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='How many users to recount in each transaction.')
+
+    def handle(self, *args, **options):
+        drifted = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                users = User.objects.filter(pk__gt=last_id).order_by('pk')
+                if not options['dry_run']:
+                    # lock the batch's users, so that a message sent or read
+                    # while they are recounted waits for the repair instead
+                    # of being overwritten by it
+                    users = users.select_for_update()
+                counts = list(users.values_list('id', 'unread_count')[:options['batch_size']])
+                if not counts:
+                    break
+                last_id = counts[-1][0]
+                repairs = self.recount(counts)
+                if not options['dry_run']:
+                    for count, user_ids in repairs.items():
+                        User.objects.filter(pk__in=user_ids).update(unread_count=count)
+            drifted += sum(len(user_ids) for user_ids in repairs.values())
+        if options['dry_run']:
+            self.stdout.write('%d users have a drifted unread count.' % drifted)
+        else:
+            self.stdout.write('Repaired the unread count of %d users.' % drifted)
+
+    def recount(self, counts):
+        '''Returns the users in counts, a list of (id, unread count), whose
+        count has drifted, grouped by their correct count so that each
+        distinct count is repaired with one UPDATE.'''
+        actual = dict(Message.objects.filter(read=False, receiver__in=[user_id for user_id, _ in counts])
+            .values('receiver').annotate(n=Count('id')).values_list('receiver', 'n'))
+        repairs = {}
+        for user_id, unread_count in counts:
+            count = actual.get(user_id, 0)
+            if unread_count != count:
+                repairs.setdefault(count, []).append(user_id)
+        return repairs
@@ -0,0 +1,65 @@
+'''refresh_weather.py - Refreshes the stored weather for every location cell
+that a user lives in, so that pages never wait on OpenWeatherMap.'''
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from distance import weather
+from distance.models import User, WeatherReport
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Refreshes the stored weather for every location cell that a user lives in.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+            help='Keep running, refreshing every INTERVAL seconds.')
+        parser.add_argument('--api-url',
+            help='OpenWeatherMap API root to use instead of WEATHER_API_URL, '
+            'such as a weather_stub server.')
+
+    def handle(self, *args, **options):
+        if not options['interval']:
+            self.refresh(options['api_url'])
+            return
+        while True:
+            started = time.time()
+            # a connection left over from the last run may have been dropped
+            # by the database while this slept
+            close_old_connections()
+            try:
+                self.refresh(options['api_url'])
+            except Exception:
+                # keep refreshing; the next run may well succeed
+                logger.exception('Could not refresh the weather; trying again in %ds', options['interval'])
+            finally:
+                close_old_connections()
+            time.sleep(max(0, options['interval'] - (time.time() - started)))
+
+    def refresh(self, api_url):
+        now = timezone.now()
+        cells = set(weather.cell_for(lat, lng)
+            for lat, lng in User.objects.values_list('lat', 'lng').distinct())
+
+        # how out of date the stored weather was before this refresh
+        ages = [(now - observed_at).total_seconds() for lat, lng, observed_at in
+            WeatherReport.objects.values_list('lat', 'lng', 'observed_at')
+            if (lat, lng) in cells]
+        if ages:
+            self.stdout.write('Staleness before refresh: oldest %ds, mean %ds, '
+                '%d of %d cells never refreshed.' % (max(ages), sum(ages) / len(ages),
+                len(cells) - len(ages), len(cells)))
+
+        started = time.time()
+        observations, requests, failures = weather.refresh_cells(cells, api_url)
+        weather.store_reports(observations, timezone.now())
+        elapsed = time.time() - started
+
+        self.stdout.write('Refreshed %d of %d cells with %d upstream requests '
+            '(%d failed) in %.2fs, %.1f cells/s.' % (len(observations), len(cells),
+            requests, failures, elapsed, len(observations) / elapsed if elapsed else 0))
@@ -0,0 +1,47 @@
+'''sync_replicas.py - Copies a SQLite default database onto the SQLite files
+standing in for its read replicas, so that the replica router can be tried
+locally without setting up replication.'''
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = ('Copies the SQLite default database onto each SQLite database in '
+        'DATABASE_REPLICAS, once or every --every seconds (to act like '
+        'replicas that are that far behind).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, default=None,
+            help='Keep copying, waiting this many seconds between copies.')
+
+    def handle(self, *args, **options):
+        aliases = ['default'] + list(settings.DATABASE_REPLICAS)
+        if len(aliases) == 1:
+            raise CommandError('DATABASE_REPLICAS is empty.')
+        for alias in aliases:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError('%s is not a SQLite database; use real replication.' % alias)
+        while True:
+            self.copy(settings.DATABASE_REPLICAS)
+            if options['every'] is None:
+                break
+            time.sleep(options['every'])
+
+    def copy(self, replicas):
+        # SQLite's backup API copies a consistent snapshot even while the
+        # site is writing
+        source = sqlite3.connect(connections['default'].settings_dict['NAME'])
+        try:
+            for alias in replicas:
+                target = sqlite3.connect(connections[alias].settings_dict['NAME'])
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+        finally:
+            source.close()
+        self.stdout.write('Copied default to %s.' % ', '.join(replicas))
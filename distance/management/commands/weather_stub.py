@@ -0,0 +1,24 @@
+'''weather_stub.py - Runs a local stand-in for the OpenWeatherMap API.'''
+from django.core.management.base import BaseCommand
+
+from distance import stubs
+
+
+class Command(BaseCommand):
+    help = 'Runs a local stand-in for the OpenWeatherMap API, for testing refresh_weather.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--latency', type=float, default=0,
+            help='Seconds to wait before answering each request.')
+
+    def handle(self, *args, **options):
+        server = stubs.StubServer(('127.0.0.1', options['port']),
+            stubs.WeatherStubHandler, options['latency'])
+        self.stdout.write('Serving stand-in weather at %s/data/2.5 (Ctrl-C to stop)' % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0009_auto_20170830_0218'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeatherReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lat', models.FloatField()),
+                ('lng', models.FloatField()),
+                ('kelvin', models.FloatField()),
+                ('status', models.CharField(max_length=100)),
+                ('observed_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='weatherreport',
+            unique_together=set([('lat', 'lng')]),
+        ),
+    ]
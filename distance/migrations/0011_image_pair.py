@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:54
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_pairs(apps, schema_editor):
+    '''Stores the two users of every existing image in canonical order.'''
+    Image = apps.get_model('distance', 'Image')
+    Image.objects.filter(user1_id__lte=models.F('user2_id')).update(
+        low_user=models.F('user1'), high_user=models.F('user2'))
+    Image.objects.filter(user1_id__gt=models.F('user2_id')).update(
+        low_user=models.F('user2'), high_user=models.F('user1'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0010_weatherreport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='high_user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='low_user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_pairs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='image',
+            name='high_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='low_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterIndexTogether(
+            name='image',
+            index_together=set([('low_user', 'high_user')]),
+        ),
+    ]
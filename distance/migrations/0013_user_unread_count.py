@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_unread(apps, schema_editor):
+    '''Sets every user's unread count from their unread messages.'''
+    User = apps.get_model('distance', 'User')
+    Message = apps.get_model('distance', 'Message')
+    counts = Message.objects.filter(read=False).values('receiver').annotate(n=models.Count('id'))
+    for row in counts:
+        User.objects.filter(pk=row['receiver']).update(unread_count=row['n'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0012_message_read_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:40
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def index_usernames(apps, schema_editor):
+    '''Stores the trigrams of every existing username.'''
+    User = apps.get_model('distance', 'User')
+    UsernameTrigram = apps.get_model('distance', 'UsernameTrigram')
+    trigrams = []
+    for user_id, username in User.objects.values_list('id', 'username').iterator():
+        text = '$' + username.lower() + '$'
+        for trigram in set(text[i:i + 3] for i in range(len(text) - 2)):
+            trigrams.append(UsernameTrigram(trigram=trigram, user_id=user_id))
+        if len(trigrams) >= 1000:
+            UsernameTrigram.objects.bulk_create(trigrams)
+            trigrams = []
+    UsernameTrigram.objects.bulk_create(trigrams)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0014_message_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsernameTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='usernametrigram',
+            index_together=set([('trigram', 'user')]),
+        ),
+        migrations.RunPython(index_usernames, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,11 @@
 '''models.py - Creates the models User, Message, and Image.'''
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, When
+from django.utils import timezone
 
 from django.contrib.auth.models import AbstractUser
-import pytz
+from . import push
+from .timezones import LazyChoices, timezone_choices
 
 from django.conf import settings
 
@@ -10,11 +13,7 @@ class User(AbstractUser):
     '''A User has a timezone, connections (users that they are friends with),
     latitude, longitude, temperature unit, city, and country, on top of the
     attributes username, email, and password in AbstractUser.'''
-    timezones = pytz.all_timezones
-    tz_tuple_list = []
-    for tz in timezones:
-        tz_tuple_list.append((tz, tz))
-    timezone = models.CharField(max_length=100, choices=tz_tuple_list)
+    timezone = models.CharField(max_length=100, choices=LazyChoices(timezone_choices))
     connections = models.ManyToManyField(settings.AUTH_USER_MODEL, null=True, blank=True)
     lat = models.FloatField(default=0)
     lng = models.FloatField(default=0)
@@ -26,10 +25,28 @@ class User(AbstractUser):
     temp_unit = models.CharField(max_length=100, choices=unit_list, default='K')
     city = models.CharField(max_length=100, default="Chicago")
     country = models.CharField(max_length=100, default="United States of America")
+    # number of unread messages received, kept up to date as messages are
+    # sent, read, and deleted (see reconcile_unread to repair it)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def change_unread_count(cls, user_id, change):
+        '''Adds change (which may be negative) to a user's unread count and
+        pushes the new count to them.'''
+        if change > 0:
+            cls.objects.filter(pk=user_id).update(unread_count=F('unread_count') + change)
+        elif change < 0:
+            # never go below zero (the column is unsigned on MySQL)
+            cls.objects.filter(pk=user_id).update(unread_count=Case(
+                When(unread_count__gt=-change, then=F('unread_count') + change),
+                default=0))
+        if change:
+            push.unread_changed(user_id)
 
 class Message(models.Model):
     '''A Message has a sender, a receiver, content, a created_at DateTimeField,
-    and a message type (either friend request or normal message).'''
+    a message type (either friend request or normal message), and whether
+    and when it was read.'''
     sender = models.ForeignKey(User, related_name="sender")
     receiver = models.ForeignKey(User, related_name="receiver")
     msg_content = models.TextField()
@@ -42,11 +59,108 @@ class Message(models.Model):
     ]
     msg_type = models.CharField(max_length=100, choices = msg_type_list, default=NORMAL_MESSAGE)
     read = models.BooleanField(default=False)
+    read_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # the inbox and unread count, a conversation with a friend, and the
+        # pending friend request check
+        index_together = [
+            ('receiver', 'read'),
+            ('receiver', 'sender'),
+            ('sender', 'receiver', 'msg_type'),
+        ]
+
+    def save(self, *args, **kwargs):
+        '''Saves the message, counting it as unread for the receiver in the
+        same transaction if it is new.'''
+        adding = self._state.adding
+        with transaction.atomic():
+            super(Message, self).save(*args, **kwargs)
+            if adding and not self.read:
+                User.change_unread_count(self.receiver_id, 1)
+
+    @classmethod
+    def mark_read(cls, msg_list):
+        '''Marks the given messages as read with a single UPDATE of just the
+        ones that are still unread, lowers the receivers' unread counts in the
+        same transaction, and updates the instances to match. Returns the
+        number of messages that were newly read.'''
+        unread = {}
+        for msg in msg_list:
+            if not msg.read:
+                unread.setdefault(msg.receiver_id, []).append(msg)
+        now = timezone.now()
+        total = 0
+        with transaction.atomic():
+            for receiver_id, receiver_unread in unread.items():
+                count = cls.objects.filter(pk__in=[msg.pk for msg in receiver_unread],
+                    read=False).update(read=True, read_at=now)
+                User.change_unread_count(receiver_id, -count)
+                total += count
+        for receiver_unread in unread.values():
+            for msg in receiver_unread:
+                msg.read = True
+                msg.read_at = now
+        return total
 
 class Image(models.Model):
     '''An Image has two users that have the Image as one of their background
-    images as well as the url to the image.'''
+    images as well as the url to the image. The two users are also stored in
+    canonical order (lower id first) as low_user and high_user so that a
+    friendship's images can be found with one indexed lookup.'''
     user1 = models.ForeignKey(User, related_name="user1")
     user2 = models.ForeignKey(User, related_name="user2")
     users = [user1, user2]
     image_url = models.URLField()
+    low_user = models.ForeignKey(User, related_name="+")
+    high_user = models.ForeignKey(User, related_name="+")
+
+    class Meta:
+        index_together = [('low_user', 'high_user')]
+
+    def save(self, *args, **kwargs):
+        self.low_user_id, self.high_user_id = sorted((self.user1_id, self.user2_id))
+        super(Image, self).save(*args, **kwargs)
+
+    @classmethod
+    def for_pair(cls, user, friend):
+        '''Returns the images that user and friend share.'''
+        low_id, high_id = sorted((user.id, friend.id))
+        return cls.objects.filter(low_user_id=low_id, high_user_id=high_id)
+
+class WeatherReport(models.Model):
+    '''A WeatherReport is the latest observation for a location cell (a
+    latitude and longitude rounded to WEATHER_CELL_DIGITS), stored as the
+    temperature in Kelvin and the detailed status. Reports are refreshed in
+    bulk by the refresh_weather command.'''
+    lat = models.FloatField()
+    lng = models.FloatField()
+    kelvin = models.FloatField()
+    status = models.CharField(max_length=100)
+    observed_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('lat', 'lng')
+
+class UsernameTrigram(models.Model):
+    '''A UsernameTrigram is one of the three letter pieces of a user's
+    lowercased username (marked with $ at both ends), so that usernames can
+    be found even when a search has typos.'''
+    trigram = models.CharField(max_length=3)
+    user = models.ForeignKey(User, related_name="+")
+
+    class Meta:
+        index_together = [('trigram', 'user')]
+
+    @staticmethod
+    def trigrams(text):
+        '''Returns the distinct trigrams of text.'''
+        text = '$' + text.lower() + '$'
+        return sorted(set(text[i:i + 3] for i in range(len(text) - 2)))
+
+    @classmethod
+    def index_users(cls, users):
+        '''Replaces the stored trigrams of the given users.'''
+        cls.objects.filter(user__in=[user.pk for user in users]).delete()
+        cls.objects.bulk_create([cls(trigram=trigram, user_id=user.pk)
+            for user in users for trigram in cls.trigrams(user.username)])
@@ -0,0 +1,179 @@
+'''performance.py - Measures where each request spends its time: SQL queries,
+calls to external services (OpenWeatherMap and Nominatim), and template
+rendering. PerformanceMiddleware reports them in a Server-Timing header and
+adds them to per-view histograms kept in memory.'''
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates, Template
+
+# upper bounds, in milliseconds, of the request duration histogram buckets
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+KINDS = ('db', 'external', 'template')
+
+_local = threading.local()
+
+
+def record(kind, seconds):
+    '''Adds seconds to the current request's time for kind. Does nothing
+    outside of a request (for example, in management commands).'''
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[kind] = timings.get(kind, 0) + seconds
+
+@contextmanager
+def timed(kind):
+    '''Records the time spent in the with block as kind.'''
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(kind, time.time() - started)
+
+
+@contextmanager
+def timed_query():
+    '''Records the time spent in the with block as one query.'''
+    try:
+        with timed('db'):
+            yield
+    finally:
+        if getattr(_local, 'timings', None) is not None:
+            _local.queries += 1
+
+
+class TimedCursorMixin:
+    '''Counts and times each query run through the cursor, like the
+    execute_wrapper hooks of newer Django versions.'''
+    def execute(self, sql, params=None):
+        with timed_query():
+            return super(TimedCursorMixin, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        with timed_query():
+            return super(TimedCursorMixin, self).executemany(sql, param_list)
+
+class TimedCursorWrapper(TimedCursorMixin, CursorWrapper):
+    pass
+
+class TimedCursorDebugWrapper(TimedCursorMixin, CursorDebugWrapper):
+    pass
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    '''Makes the connection's cursors count and time their queries. Unlike
+    turning on the query log, the SQL of each query is not kept.'''
+    connection.make_cursor = lambda cursor: TimedCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: TimedCursorDebugWrapper(cursor, connection)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return super(TimedTemplate, self).render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    '''The Django template backend, with rendering time recorded. Only the
+    outermost render is timed, so included templates are not counted twice.'''
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super(TimedDjangoTemplates, self).get_template(template_name).template, self)
+
+
+class ViewStats:
+    '''Totals and a duration histogram for the requests to one view.'''
+    def __init__(self):
+        self.requests = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.queries = 0
+        self.seconds = dict((kind, 0.0) for kind in KINDS)
+        self.buckets = [0] * len(BUCKETS_MS)
+
+    def add(self, duration, queries, timings):
+        self.requests += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.queries += queries
+        for kind in KINDS:
+            self.seconds[kind] += timings.get(kind, 0)
+        ms = duration * 1000
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def as_dict(self):
+        per_request = lambda value: round(value / self.requests, 2)
+        return {
+            'requests': self.requests,
+            'mean_ms': per_request(self.total * 1000),
+            'max_ms': round(self.max * 1000, 2),
+            'mean_queries': per_request(self.queries),
+            'mean_db_ms': per_request(self.seconds['db'] * 1000),
+            'mean_external_ms': per_request(self.seconds['external'] * 1000),
+            'mean_template_ms': per_request(self.seconds['template'] * 1000),
+            'histogram_ms': [['+Inf' if bound == float('inf') else bound, count]
+                for bound, count in zip(BUCKETS_MS, self.buckets)],
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def add_request(view_name, duration, queries, timings):
+    with _stats_lock:
+        stats = _stats.get(view_name)
+        if stats is None:
+            stats = _stats[view_name] = ViewStats()
+        stats.add(duration, queries, timings)
+
+def snapshot():
+    '''Returns the statistics of every view so far, keyed by view name.'''
+    with _stats_lock:
+        return dict((name, stats.as_dict()) for name, stats in _stats.items())
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
+
+
+class PerformanceMiddleware:
+    '''Times each request and the SQL queries, external calls, and template
+    rendering inside it (queries are counted by the cursors of time_queries).
+    The totals are sent in a Server-Timing header to staff, to everyone when
+    DEBUG is on, or to every visitor when SERVER_TIMING is on.'''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.timings = {}
+        _local.queries = 0
+        started = time.time()
+        try:
+            response = self.get_response(request)
+        finally:
+            duration = time.time() - started
+            timings = _local.timings
+            queries = _local.queries
+            _local.timings = None
+        match = request.resolver_match
+        add_request(match.view_name if match else 'unresolved', duration, queries, timings)
+        user = getattr(request, 'user', None)
+        if settings.SERVER_TIMING or settings.DEBUG or (user is not None and user.is_staff):
+            response['Server-Timing'] = ', '.join([
+                'db;desc="%d queries";dur=%.1f' % (queries, timings.get('db', 0) * 1000),
+                'external;dur=%.1f' % (timings.get('external', 0) * 1000),
+                'template;dur=%.1f' % (timings.get('template', 0) * 1000),
+                'total;dur=%.1f' % (duration * 1000),
+            ])
+        return response
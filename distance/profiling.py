@@ -0,0 +1,94 @@
+'''profiling.py - Lets staff profile a single request to any page of the site
+by adding ?profile=1 to its url (or sending an X-Profile: 1 header). The view
+is run under cProfile and the profile is saved to PROFILE_DIR, which keeps
+only the newest PROFILE_KEEP profiles. Staff can list and read them at
+/profiles/.'''
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import re
+
+from django.conf import settings
+from django.utils import timezone
+
+# profile names are generated here, so anything else is refused
+NAME_PATTERN = re.compile(r'^[\w.-]+\.prof$')
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+
+def wants_profile(request):
+    return request.GET.get('profile') == '1' or request.META.get('HTTP_X_PROFILE') == '1'
+
+def save(profiler, view_name):
+    '''Saves a profile under a name made from the time and the view, removes
+    the oldest profiles past PROFILE_KEEP, and returns the name.'''
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    name = '%s-%s.prof' % (timezone.now().strftime('%Y%m%d-%H%M%S-%f'),
+        re.sub(r'[^\w.-]', '_', view_name))
+    profiler.dump_stats(os.path.join(settings.PROFILE_DIR, name))
+    for old in list_profiles()[settings.PROFILE_KEEP:]:
+        try:
+            os.remove(path_for(old['name']))
+        except OSError:
+            # another request removed it first
+            pass
+    return name
+
+def list_profiles():
+    '''Returns the name, size, and time of every saved profile, newest
+    first.'''
+    try:
+        names = [name for name in os.listdir(settings.PROFILE_DIR) if NAME_PATTERN.match(name)]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        try:
+            info = os.stat(os.path.join(settings.PROFILE_DIR, name))
+        except OSError:
+            continue
+        profiles.append({
+            'name': name,
+            'size': info.st_size,
+            'created_at': datetime.datetime.fromtimestamp(info.st_mtime, timezone.utc),
+        })
+    profiles.sort(key=lambda profile: profile['name'], reverse=True)
+    return profiles
+
+def path_for(name):
+    '''Returns the path of a saved profile, or None if there is no such
+    profile.'''
+    if not NAME_PATTERN.match(name):
+        return None
+    path = os.path.join(settings.PROFILE_DIR, name)
+    return path if os.path.exists(path) else None
+
+def summarize(path, sort='cumulative', limit=60):
+    '''Returns the slowest limit functions in a profile as text.'''
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.strip_dirs().sort_stats(sort if sort in SORT_KEYS else 'cumulative').print_stats(limit)
+    return output.getvalue()
+
+
+class ProfilerMiddleware:
+    '''Runs the view of a staff user's request under cProfile when they ask
+    for it. It should come last in MIDDLEWARE, so that the other
+    middleware's process_view hooks (such as the CSRF check) still run.'''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not wants_profile(request) or request.resolver_match.namespace != 'distance':
+            return None
+        if not (request.user.is_authenticated and request.user.is_staff):
+            return None
+        profiler = cProfile.Profile()
+        response = profiler.runcall(view_func, request, *view_args, **view_kwargs)
+        response['X-Profile'] = save(profiler, request.resolver_match.view_name)
+        return response
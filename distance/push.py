@@ -0,0 +1,124 @@
+'''push.py - Pushes events (new messages and unread count changes) to the
+browsers of the users they concern over Server-Sent Events. Events go through
+a channel layer chosen by the PUSH_CHANNEL_LAYER setting. The default one
+delivers them within this process, so it needs no other services but only
+reaches users connected to the same process; a layer backed by a shared
+broker can be swapped in by implementing the same methods.'''
+import json
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+
+class InMemoryChannelLayer:
+    '''Delivers events to the listeners in this process. Each listener has a
+    bounded queue, and events for a listener that has fallen behind are
+    dropped rather than held forever.'''
+    def __init__(self):
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        '''Returns a new queue that receives the events for user_id.'''
+        listener = queue.Queue(maxsize=settings.PUSH_QUEUE_SIZE)
+        with self._lock:
+            self._listeners.setdefault(user_id, set()).add(listener)
+        return listener
+
+    def unsubscribe(self, user_id, listener):
+        with self._lock:
+            listeners = self._listeners.get(user_id, set())
+            listeners.discard(listener)
+            if not listeners:
+                self._listeners.pop(user_id, None)
+
+    def has_listeners(self, user_id):
+        with self._lock:
+            return user_id in self._listeners
+
+    def publish(self, user_id, event, data):
+        with self._lock:
+            listeners = list(self._listeners.get(user_id, ()))
+        for listener in listeners:
+            try:
+                listener.put_nowait((event, data))
+            except queue.Full:
+                pass
+
+
+_layer = None
+_layer_lock = threading.Lock()
+
+
+def get_layer():
+    '''Returns the channel layer named by PUSH_CHANNEL_LAYER, creating it on
+    first use.'''
+    global _layer
+    with _layer_lock:
+        if _layer is None:
+            _layer = import_string(settings.PUSH_CHANNEL_LAYER)()
+        return _layer
+
+def publish(user_id, event, data):
+    '''Sends an event to user_id's browsers once the current transaction
+    commits, if PUSH_ENABLED is set.'''
+    if not settings.PUSH_ENABLED:
+        return
+    transaction.on_commit(lambda: get_layer().publish(user_id, event, data))
+
+def message_sent(msg):
+    publish(msg.receiver_id, 'new_message', {
+        'id': msg.id,
+        'sender_id': msg.sender_id,
+        'msg_type': msg.msg_type,
+    })
+
+def unread_changed(user_id):
+    '''Sends a user their new unread count, read once the change commits and
+    only if they might be listening.'''
+    if not settings.PUSH_ENABLED:
+        return
+    def send():
+        layer = get_layer()
+        if not layer.has_listeners(user_id):
+            return
+        from .models import User
+        count = User.objects.filter(pk=user_id).values_list('unread_count', flat=True).first()
+        if count is not None:
+            layer.publish(user_id, 'unread', {'count': count})
+    transaction.on_commit(send)
+
+def format_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+def stream(user_id, unread_count):
+    '''Yields a user's events in the Server-Sent Events format, starting with
+    their current unread count. A comment is sent every
+    PUSH_KEEPALIVE_SECONDS to keep the connection open, and the stream ends
+    after PUSH_STREAM_SECONDS so that the browser reconnects and the worker
+    is freed now and then.'''
+    # the stream stays open for minutes without running queries, so give
+    # the request's database connections back first
+    for connection in connections.all():
+        connection.close()
+    layer = get_layer()
+    listener = layer.subscribe(user_id)
+    try:
+        # ask the browser to wait a few seconds before reconnecting
+        yield 'retry: 5000\n\n'
+        yield format_event('unread', {'count': unread_count})
+        ends = time.time() + settings.PUSH_STREAM_SECONDS
+        while time.time() < ends:
+            try:
+                event, data = listener.get(timeout=min(settings.PUSH_KEEPALIVE_SECONDS,
+                    max(0, ends - time.time())))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield format_event(event, data)
+    finally:
+        layer.unsubscribe(user_id, listener)
@@ -0,0 +1,175 @@
+'''replicas.py - Sends reads to the read replicas named in DATABASE_REPLICAS
+and writes to the primary (default) database. A browser that has just
+written anything reads from the primary for the next REPLICA_PIN_SECONDS, so
+that it sees its own writes (such as a message it just sent) even if the
+replicas are behind, and so does any request that reads a version counter
+(see versions.py) that was bumped that recently. Replicas are checked every
+REPLICA_HEALTH_CHECK_SECONDS, and ones that are down or too far behind are
+skipped until they recover.
+
+ReplicaMiddleware also checks persistent connections (CONN_MAX_AGE) that
+have been idle for CONN_HEALTH_CHECK_SECONDS before a request uses them, so
+that a connection the server dropped is reopened instead of failing the
+request.'''
+from contextlib import contextmanager
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = 'default'
+# set for REPLICA_PIN_SECONDS on browsers that have just written
+PIN_COOKIE = 'read_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+_local = threading.local()
+# alias: (checked at, healthy)
+_health = {}
+_health_lock = threading.Lock()
+
+
+def pin():
+    '''Sends the rest of this request's (or thread's) reads to the primary.'''
+    _local.pinned = True
+
+def is_pinned():
+    return (getattr(_local, 'pinned', False) or getattr(_local, 'wrote', False)
+        or getattr(_local, 'forced', 0) > 0 or connections[PRIMARY].in_atomic_block)
+
+@contextmanager
+def use_primary():
+    '''Reads from the primary in the with block, for reads that must not be
+    behind (such as ones that fill a cache).'''
+    _local.forced = getattr(_local, 'forced', 0) + 1
+    try:
+        yield
+    finally:
+        _local.forced -= 1
+
+def reset():
+    _local.pinned = False
+    _local.wrote = False
+
+
+def replication_lag(connection, cursor):
+    '''Returns how many seconds a MySQL replica is behind (None if it is not
+    replicating), or None for other databases.'''
+    if connection.vendor != 'mysql':
+        return None
+    cursor.execute('SHOW SLAVE STATUS')
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    status = dict(zip([column[0] for column in cursor.description], row))
+    lag = status.get('Seconds_Behind_Master')
+    # replication has stopped
+    return float('inf') if lag is None else lag
+
+def check(alias):
+    '''Returns whether a replica answers and is at most
+    REPLICA_MAX_LAG_SECONDS behind.'''
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            lag = replication_lag(connection, cursor) if settings.REPLICA_MAX_LAG_SECONDS else None
+    except DatabaseError as e:
+        logger.warning('Replica %s is down: %s', alias, e)
+        connection.close()
+        return False
+    if lag is not None and lag > settings.REPLICA_MAX_LAG_SECONDS:
+        logger.warning('Replica %s is %s seconds behind', alias, lag)
+        return False
+    return True
+
+def is_healthy(alias):
+    '''Returns whether a replica was healthy when last checked, checking it
+    again if that was over REPLICA_HEALTH_CHECK_SECONDS ago. Only one thread
+    checks at a time; the others use the last result meanwhile.'''
+    now = time.time()
+    with _health_lock:
+        checked_at, healthy = _health.get(alias, (0, True))
+        if now - checked_at < settings.REPLICA_HEALTH_CHECK_SECONDS:
+            return healthy
+        _health[alias] = (now, healthy)
+    healthy = check(alias)
+    with _health_lock:
+        _health[alias] = (now, healthy)
+    return healthy
+
+def choose_replica():
+    '''Returns a random healthy replica, or the primary if there are none.'''
+    healthy = [alias for alias in settings.DATABASE_REPLICAS if is_healthy(alias)]
+    return random.choice(healthy) if healthy else PRIMARY
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or is_pinned():
+            return PRIMARY
+        return choose_replica()
+
+    def db_for_write(self, model, **hints):
+        # everything this request reads from now on must include the write
+        _local.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [PRIMARY] + list(settings.DATABASE_REPLICAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their tables by replication
+        return db not in settings.DATABASE_REPLICAS
+
+
+def check_connections():
+    '''Closes this thread's persistent connections that have been idle for
+    over CONN_HEALTH_CHECK_SECONDS and no longer work, so that they are
+    reopened when next used.'''
+    now = time.time()
+    last_used = getattr(_local, 'last_used', {})
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        if now - last_used.get(connection.alias, now) > settings.CONN_HEALTH_CHECK_SECONDS:
+            if not connection.is_usable():
+                connection.close()
+
+def mark_used():
+    now = time.time()
+    _local.last_used = dict((connection.alias, now) for connection in connections.all()
+        if connection.connection is not None)
+
+
+class ReplicaMiddleware:
+    '''Checks the persistent connections before each request, reads from the
+    primary for requests that write or come soon after a write by the same
+    browser, and marks the browser as having written. It should come early
+    in MIDDLEWARE, so that the session and user are read from the right
+    database.'''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        check_connections()
+        reset()
+        if request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES:
+            pin()
+        try:
+            response = self.get_response(request)
+            wrote = getattr(_local, 'wrote', False) or request.method not in SAFE_METHODS
+        finally:
+            reset()
+            mark_used()
+        if wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE, httponly=True)
+        return response
@@ -0,0 +1,43 @@
+'''search.py - Finds users by username for the friend search.'''
+import math
+
+from django.conf import settings
+from django.db.models import Case, Count, Exists, IntegerField, OuterRef, Q, Subquery, Value, When
+
+from .models import User, Message, UsernameTrigram
+
+
+def search_users(user, query):
+    '''Returns the users (other than user) whose usernames match query: the
+    exact username first, then usernames starting with query, then usernames
+    sharing at least SEARCH_MIN_SIMILARITY of query's trigrams, most shared
+    first. Each result is annotated with already_friends and pending (whether
+    user has sent them a friend request), so one query resolves a page.'''
+    trigrams = UsernameTrigram.trigrams(query)
+    min_shared = max(1, int(math.ceil(len(trigrams) * settings.SEARCH_MIN_SIMILARITY)))
+    similar = (UsernameTrigram.objects.filter(trigram__in=trigrams)
+        .values('user').annotate(shared=Count('id')).filter(shared__gte=min_shared)
+        .values('user'))
+    shared = (UsernameTrigram.objects.filter(user=OuterRef('pk'), trigram__in=trigrams)
+        .values('user').annotate(shared=Count('id')).values('shared'))
+    friendships = User.connections.through.objects.filter(from_user_id=user.pk, to_user_id=OuterRef('pk'))
+    friend_requests = Message.objects.filter(sender_id=user.pk, receiver_id=OuterRef('pk'),
+        msg_type=Message.FRIEND_REQUEST)
+    # a range on username (rather than LIKE) so that the prefix match uses
+    # the username index on every database. The bound is the last character
+    # of the Basic Multilingual Plane, since MySQL's utf8 charset cannot hold
+    # the ones after it.
+    prefixed = User.objects.filter(username__gte=query, username__lt=query + '\uffff').values('pk')
+    return (User.objects
+        .filter(Q(pk__in=prefixed) | Q(pk__in=similar))
+        .exclude(pk=user.pk)
+        .annotate(
+            exact=Case(When(username__iexact=query, then=Value(1)), default=Value(0),
+                output_field=IntegerField()),
+            prefix=Case(When(username__startswith=query, then=Value(1)), default=Value(0),
+                output_field=IntegerField()),
+            shared=Subquery(shared, output_field=IntegerField()),
+            already_friends=Exists(friendships),
+            pending=Exists(friend_requests))
+        .order_by('-exact', '-prefix', '-shared', 'username')
+        .only('id', 'username'))
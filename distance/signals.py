@@ -0,0 +1,57 @@
+'''signals.py - Keeps denormalized data in sync when models change.'''
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import friendships, push, versions
+from .models import User, Message, Image, UsernameTrigram
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    '''Stops counting a deleted message as unread. Deletions send this signal
+    inside their transaction, so the count changes with the delete.'''
+    if not instance.read:
+        User.change_unread_count(instance.receiver_id, -1)
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def message_changed(sender, instance, **kwargs):
+    '''Marks the conversation between the sender and receiver as changed.'''
+    versions.bump(versions.pair_key(instance.sender_id, instance.receiver_id))
+
+@receiver(post_save, sender=Message)
+def message_created(sender, instance, created, **kwargs):
+    '''Tells the receiver about new messages and friend requests.'''
+    if created:
+        push.message_sent(instance)
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def image_changed(sender, instance, **kwargs):
+    '''Marks the images the two users share as changed.'''
+    versions.bump(versions.pair_key(instance.user1_id, instance.user2_id))
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    '''Indexes the username of new users, and of users saved with a changed
+    username, for the friend search, and marks the user as changed.'''
+    if created or (update_fields and 'username' in update_fields):
+        UsernameTrigram.index_users([instance])
+    versions.bump(versions.user_key(instance.pk))
+
+@receiver(m2m_changed, sender=User.connections.through)
+def connections_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Drops the cached friends of both sides of any added or removed
+    connection. A clear has no pk_set, so the users on the other side are
+    read before it happens.'''
+    if action in ('post_add', 'post_remove'):
+        friendships.invalidate([instance.pk] + list(pk_set or ()))
+    elif action == 'pre_clear':
+        # a reverse clear (user.user_set.clear()) removes the rows pointing
+        # at instance rather than the ones from it
+        rows = User.connections.through.objects
+        if reverse:
+            others = rows.filter(to_user_id=instance.pk).values_list('from_user_id', flat=True)
+        else:
+            others = rows.filter(from_user_id=instance.pk).values_list('to_user_id', flat=True)
+        friendships.invalidate([instance.pk] + list(others))
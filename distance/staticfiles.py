@@ -0,0 +1,158 @@
+'''staticfiles.py - The static files pipeline. collectstatic gives every file a
+name with a hash of its contents (listed in a manifest), shrinks oversized
+images, and writes gzip (and, if the brotli package is installed, brotli)
+copies of text files next to them. Since a hashed name changes whenever the
+file does, the files can be cached by browsers forever; serve() does so when
+no web server is set up to serve STATIC_ROOT itself.'''
+import gzip
+import io
+import mimetypes
+import os
+import posixpath
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# text files worth compressing; images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.txt', '.html', '.xml', '.ico', '.map')
+IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+# extensions of the precompressed copies, and their Content-Encoding, in the
+# order they are preferred
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+
+
+def shrink_image(content, image_format):
+    '''Returns the image as it would be saved again without its metadata
+    (such as EXIF), no larger than STATIC_IMAGE_MAX_SIZE pixels on either
+    side, and with JPEG quality STATIC_JPEG_QUALITY.'''
+    from PIL import Image as PILImage
+    image = PILImage.open(io.BytesIO(content))
+    image.thumbnail((settings.STATIC_IMAGE_MAX_SIZE, settings.STATIC_IMAGE_MAX_SIZE))
+    output = io.BytesIO()
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(output, 'JPEG', quality=settings.STATIC_JPEG_QUALITY, optimize=True,
+            progressive=True)
+    else:
+        image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+def compress(content):
+    '''Returns the precompressed copies of content, keyed by extension.'''
+    copies = {'.gz': gzip.compress(content, 9)}
+    if brotli is not None:
+        copies['.br'] = brotli.compress(content)
+    return copies
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    '''ManifestStaticFilesStorage, which hashes the names of the files, with
+    images shrunk before they are hashed and compressed copies of the text
+    files written after.'''
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            return
+        paths = self.shrink_images(paths)
+        for processed in super(CompressedManifestStaticFilesStorage, self).post_process(
+                paths, dry_run, **options):
+            yield processed
+        for hashed_name in self.hashed_files.values():
+            if hashed_name.lower().endswith(COMPRESSIBLE):
+                for compressed_name in self.write_compressed(hashed_name):
+                    yield hashed_name, compressed_name, True
+
+    def shrink_images(self, paths):
+        '''Replaces the collected copies of the images over
+        STATIC_IMAGE_MAX_BYTES with shrunk ones, when that makes them smaller,
+        and returns paths with those images read from the copies. Does nothing
+        if Pillow is not installed.'''
+        # Pillow is slow to import, so it is only loaded by collectstatic
+        try:
+            import PIL.Image
+        except ImportError:
+            return paths
+        paths = dict(paths)
+        for name, (storage, path) in list(paths.items()):
+            image_format = IMAGE_FORMATS.get(os.path.splitext(name)[1].lower())
+            if image_format is None or storage.size(path) <= settings.STATIC_IMAGE_MAX_BYTES:
+                continue
+            with storage.open(path) as original:
+                content = original.read()
+            try:
+                shrunk = shrink_image(content, image_format)
+            except (IOError, OSError, SyntaxError):
+                # not an image Pillow can read; leave it as it is
+                continue
+            if len(shrunk) < len(content):
+                self.delete(name)
+                self._save(name, ContentFile(shrunk))
+                paths[name] = (self, name)
+        return paths
+
+    def write_compressed(self, name):
+        '''Writes the copies of a file that are smaller than it, and returns
+        their names.'''
+        with self.open(name) as original:
+            content = original.read()
+        names = []
+        for extension, compressed in sorted(compress(content).items()):
+            if len(compressed) < len(content):
+                if self.exists(name + extension):
+                    self.delete(name + extension)
+                self._save(name + extension, ContentFile(compressed))
+                names.append(name + extension)
+        return names
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = part.partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0'):
+            encodings.add(coding.strip().lower())
+    return encodings
+
+def serve(request, path):
+    '''Serves a collected static file from STATIC_ROOT, precompressed if the
+    browser accepts it. Files with hashed names are cached for
+    STATIC_MAX_AGE seconds, and any others are checked again every time.'''
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith('..') or path.endswith(tuple(extension for extension, _ in ENCODINGS)):
+        raise Http404
+    full_path = os.path.join(settings.STATIC_ROOT, path)
+    if not os.path.isfile(full_path):
+        raise Http404
+    modified = os.stat(full_path).st_mtime
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), modified):
+        return HttpResponseNotModified()
+    content_type, encoding = mimetypes.guess_type(full_path)
+    accepted = accepted_encodings(request)
+    for extension, coding in ENCODINGS:
+        if coding in accepted and os.path.isfile(full_path + extension):
+            full_path += extension
+            encoding = coding
+            break
+    response = FileResponse(open(full_path, 'rb'),
+        content_type=content_type or 'application/octet-stream')
+    response['Content-Length'] = os.path.getsize(full_path)
+    response['Last-Modified'] = http_date(modified)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if path.lower().endswith(COMPRESSIBLE):
+        patch_vary_headers(response, ('Accept-Encoding',))
+    if path in getattr(staticfiles_storage, 'hashed_files', {}).values():
+        patch_cache_control(response, public=True, max_age=settings.STATIC_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+    return response
@@ -0,0 +1,155 @@
+'''stubs.py - Local stand-ins for the external services the site talks to,
+so that workers and benchmarks can run without network access or API keys.'''
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import math
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+import zlib
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    '''A threaded HTTP server that waits latency seconds before answering
+    each request and counts the requests it has answered.'''
+    daemon_threads = True
+
+    def __init__(self, address, handler, latency=0):
+        HTTPServer.__init__(self, address, handler)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Base handler that sleeps for the server's latency, dispatches GET
+    requests to handle_path(path, params), and sends back the returned JSON
+    (or, if it returns a (content type, bytes) tuple, those bytes).'''
+    def do_GET(self):
+        self.server.count_request()
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        data = self.handle_path(url.path, params)
+        if data is None:
+            self.send_error(404)
+            return
+        if isinstance(data, tuple):
+            content_type, body = data
+        else:
+            content_type, body = 'application/json', json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_path(self, path, params):
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+STATUSES = ['clear sky', 'few clouds', 'scattered clouds', 'broken clouds',
+    'light rain', 'moderate rain', 'mist', 'light snow']
+
+def fake_weather(lat, lng):
+    '''Returns an OpenWeatherMap style observation that is warmer near the
+    equator and stays the same for the same coordinates.'''
+    kelvin = round(250 + 50 * math.cos(math.radians(lat)), 2)
+    status = STATUSES[int(abs(lat * 7 + lng * 13)) % len(STATUSES)]
+    return {
+        'coord': {'lat': lat, 'lon': lng},
+        'main': {'temp': kelvin},
+        'weather': [{'description': status}],
+    }
+
+
+class WeatherStubHandler(StubHandler):
+    '''Answers the OpenWeatherMap /weather and /box/city endpoints. The box
+    endpoint returns a city every quarter of a degree.'''
+    def handle_path(self, path, params):
+        if path.endswith('/weather'):
+            return fake_weather(float(params['lat']), float(params['lon']))
+        if path.endswith('/box/city'):
+            lng_left, lat_bottom, lng_right, lat_top = [float(value)
+                for value in params['bbox'].split(',')[:4]]
+            cities = []
+            lat = math.ceil(lat_bottom * 4) / 4
+            while lat <= lat_top:
+                lng = math.ceil(lng_left * 4) / 4
+                while lng <= lng_right:
+                    city = fake_weather(lat, lng)
+                    city['coord'] = {'Lat': lat, 'Lon': lng}
+                    cities.append(city)
+                    lng += 0.25
+                lat += 0.25
+            return {'cod': 200, 'cnt': len(cities), 'list': cities}
+        return None
+
+
+class NominatimStubHandler(StubHandler):
+    '''Answers the Nominatim /reverse endpoint with a made up city named
+    after the coordinates.'''
+    def handle_path(self, path, params):
+        if path.endswith('/reverse'):
+            lat, lng = float(params['lat']), float(params['lon'])
+            city = 'Stub City %d %d' % (round(lat), round(lng))
+            return {
+                'lat': str(lat),
+                'lon': str(lng),
+                'display_name': city + ', Stubland',
+                'address': {'city': city, 'country': 'Stubland'},
+            }
+        return None
+
+
+# a 1x1 GIF, served instead of generated images when Pillow is not installed
+PIXEL_GIF = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04'
+    b'\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+
+
+class ImageStubHandler(StubHandler):
+    '''Answers any path ending in .jpg with a noisy JPEG of a colour made
+    from the path, w by h pixels (2000 by 1500 unless given), like the
+    full-size photos users link to.'''
+    def handle_path(self, path, params):
+        if not path.endswith('.jpg'):
+            return None
+        if PILImage is None:
+            return ('image/gif', PIXEL_GIF)
+        seed = zlib.crc32(path.encode('utf-8'))
+        colour = (seed & 0xff, (seed >> 8) & 0xff, (seed >> 16) & 0xff)
+        size = (int(params.get('w', 2000)), int(params.get('h', 1500)))
+        # noise, so that it is about as hard to compress as a photo
+        image = PILImage.blend(PILImage.new('RGB', size, colour),
+            PILImage.effect_noise(size, 48).convert('RGB'), 0.3)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=95)
+        return ('image/jpeg', output.getvalue())
+
+
+def start(handler, port=0, latency=0):
+    '''Starts a stub server in a background thread and returns it. Port 0
+    picks a free port; the chosen one is in server.url.'''
+    server = StubServer(('127.0.0.1', port), handler, latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
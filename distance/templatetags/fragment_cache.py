@@ -0,0 +1,57 @@
+'''fragment_cache.py - The cachefragment tag, which caches the part of a
+template between it and endcachefragment:
+
+    {% load fragment_cache %}
+    {% cachefragment "slideshow" user.pk|pair_version:friend.pk %}
+        ...
+    {% endcachefragment %}
+
+The first argument names the fragment. The rest are what it varies on;
+version counter keys (made by the filters below) are replaced by the
+counters' values, so the fragment is rendered again after the data they
+cover changes. Fragments must not contain {% csrf_token %}, since the token
+differs between users.'''
+from django import template
+
+from distance import fragments, versions
+
+register = template.Library()
+
+
+@register.filter
+def user_version(user_id):
+    '''The version counter key of a user's own settings and location.'''
+    return versions.user_key(user_id)
+
+@register.filter
+def friends_version(user_id):
+    '''The version counter key of a user's friends.'''
+    return versions.friends_key(user_id)
+
+@register.filter
+def pair_version(user_id, other_id):
+    '''The version counter key of the messages and images two users share.'''
+    return versions.pair_key(user_id, other_id)
+
+
+class FragmentNode(template.Node):
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        return fragments.get_or_render(self.name.resolve(context),
+            [value.resolve(context) for value in self.vary_on],
+            lambda: self.nodelist.render(context))
+
+
+@register.tag
+def cachefragment(parser, token):
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError("'%s' needs a fragment name." % bits[0])
+    nodelist = parser.parse(('endcachefragment',))
+    parser.delete_first_token()
+    return FragmentNode(nodelist, parser.compile_filter(bits[1]),
+        [parser.compile_filter(bit) for bit in bits[2:]])
@@ -0,0 +1,41 @@
+'''image_proxy.py - The proxied_image tag, which shows a background image
+through the image proxy:
+
+    {% load image_proxy %}
+    {% proxied_image image "background" "100vw" "width:100%" %}
+
+The arguments after the url are the img's class, the sizes it is shown at
+(so the browser can pick the smallest width that fits), and its style.'''
+from django import template
+from django.conf import settings
+from django.forms.utils import flatatt
+from django.urls import reverse
+from django.utils.html import format_html
+
+from distance import imageproxy
+
+register = template.Library()
+
+
+@register.simple_tag
+def proxied_image(url, css_class='', sizes='100vw', style=''):
+    '''Renders a picture element with the image as WebP for the browsers that
+    support it and as JPEG for the rest, in every width of
+    PROXY_IMAGE_WIDTHS.'''
+    token = imageproxy.sign(url)
+    widths = settings.PROXY_IMAGE_WIDTHS
+    src = lambda width, extension: reverse('distance:proxied_image', args=(token, width, extension))
+    srcset = lambda extension: ', '.join('%s %dw' % (src(width, extension), width) for width in widths)
+    attrs = {'alt': '', 'src': src(widths[-1], 'jpg')}
+    if css_class:
+        attrs['class'] = css_class
+    if style:
+        attrs['style'] = style
+    if not imageproxy.pillow_installed():
+        # without Pillow every width is the original, so one is enough
+        return format_html('<img{}>', flatatt(attrs))
+    attrs.update({'srcset': srcset('jpg'), 'sizes': sizes})
+    source = ''
+    if imageproxy.webp_supported():
+        source = format_html('<source type="image/webp" srcset="{}" sizes="{}">', srcset('webp'), sizes)
+    return format_html('<picture>{}<img{}></picture>', source, flatatt(attrs))
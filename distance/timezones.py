@@ -0,0 +1,94 @@
+'''timezones.py - Looks up UTC offsets for users' timezones. Each zone's
+offsets and DST transitions are worked out once and cached until its next
+transition, so a page can get a zone's offset without reparsing pytz output,
+and the browser can be handed the upcoming transitions so that its clocks
+stay right across DST changes without reloading.'''
+import bisect
+import calendar
+import datetime
+import functools
+import threading
+import time
+
+from django.conf import settings
+import pytz
+
+
+@functools.lru_cache(maxsize=None)
+def get_zone(name):
+    '''Returns the pytz timezone for a name, creating it only once.'''
+    return pytz.timezone(name)
+
+@functools.lru_cache(maxsize=None)
+def zone_transitions(name):
+    '''Returns the UTC times (in seconds since the epoch) at which a zone's
+    offset changes and the offset (in minutes) that starts at each.'''
+    zone = get_zone(name)
+    times = getattr(zone, '_utc_transition_times', None)
+    if not times:
+        # a zone with a fixed offset, such as UTC
+        offset = zone.utcoffset(datetime.datetime(2000, 1, 1))
+        return ([0], [int(offset.total_seconds() // 60)])
+    starts = [calendar.timegm(when.timetuple()) for when in times]
+    offsets = [int(info[0].total_seconds() // 60) for info in zone._transition_info]
+    return (starts, offsets)
+
+
+@functools.lru_cache(maxsize=None)
+def timezone_choices():
+    '''Returns the (name, name) choices for every pytz timezone, building
+    them the first time they are asked for.'''
+    return [(name, name) for name in pytz.all_timezones]
+
+
+class LazyChoices:
+    '''Model field choices that call build() the first time they are used
+    rather than when the model is defined.'''
+    def __init__(self, build):
+        self.build = build
+
+    def __iter__(self):
+        return iter(self.build())
+
+    def __len__(self):
+        return len(self.build())
+
+    def __bool__(self):
+        # fields check whether they have choices when they are created, so
+        # answer without building them
+        return True
+
+
+# zone name -> (time the schedule is good until, schedule)
+_schedules = {}
+_schedules_lock = threading.Lock()
+
+
+def offset_schedule(name, now=None):
+    '''Returns a zone's offsets from now until TZ_SCHEDULE_DAYS from now, as
+    a list of [start, offset] pairs where start is in milliseconds since the
+    epoch (the first pair starts at 0) and offset is in minutes. The schedule
+    is reused until the zone's next transition.'''
+    now = time.time() if now is None else now
+    with _schedules_lock:
+        cached = _schedules.get(name)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    starts, offsets = zone_transitions(name)
+    current = max(bisect.bisect_right(starts, now) - 1, 0)
+    last = bisect.bisect_right(starts, now + settings.TZ_SCHEDULE_DAYS * 24 * 60 * 60)
+    schedule = [[0, offsets[current]]]
+    for i in range(current + 1, last):
+        schedule.append([starts[i] * 1000, offsets[i]])
+    # rebuild at the next transition, or after a day so that the schedule
+    # keeps reaching TZ_SCHEDULE_DAYS ahead
+    good_until = now + 24 * 60 * 60
+    if current + 1 < len(starts):
+        good_until = min(good_until, starts[current + 1])
+    with _schedules_lock:
+        _schedules[name] = (good_until, schedule)
+    return schedule
+
+def utc_offset(name, now=None):
+    '''Returns a zone's UTC offset in minutes.'''
+    return offset_schedule(name, now)[0][1]
@@ -3,8 +3,6 @@ in, log out, passwords, or the admin site)'''
 from django.conf.urls import url
 
 from . import views
-# for favicon and menu, need RedirectView
-from django.views.generic.base import RedirectView
 
 app_name = 'distance'
 urlpatterns = [
@@ -22,16 +20,27 @@ urlpatterns = [
     # Accepting friend request
     url(r'^accept/$', views.accept, name='accept'),
 
+    # Accepting, rejecting, deleting, or reading many messages at once
+    url(r'^inbox_action/$', views.inbox_action, name='inbox_action'),
+
+    # New messages and unread counts, pushed as they happen
+    url(r'^events/$', views.events, name='events'),
+
     # View list of friends
     url(r'^friends/$', views.friends, name='friends'),
 
     # View homepage with a given friend
     url(r'^friends/(?P<friend_id>[0-9]+)/$', views.friend_view, name='friend_view'),
+    url(r'^friends/(?P<friend_id>[0-9]+)/data/$', views.friend_data, name='friend_data'),
 
     # Add images to a given friend's homepage background
     url(r'^friends/(?P<friend_id>[0-9]+)/add_images/$', views.add_images, name='add_images'),
     url(r'^friends/(?P<friend_id>[0-9]+)/image_confirm/$', views.image_confirm, name='image_confirm'),
 
+    # Background images, resized and cached by the image proxy
+    url(r'^images/(?P<token>[\w:-]+)/(?P<width>[0-9]+)\.(?P<image_format>webp|jpg)$', views.proxied_image,
+        name='proxied_image'),
+
     # Send a message
     url(r'^send_msg/$', views.send_msg, name="send_msg"),
     url(r'^friends/(?P<friend_id>[0-9]+)/send_msg/$', views.send_msg, name='send_msg_f'),
@@ -46,11 +55,10 @@ urlpatterns = [
     url(r'^settings_view/$', views.settings_view, name='settings_view'),
     url(r'^settings_set/$', views.settings_set, name='settings_set'),
 
-    # Images on the site
-    url(r'^background\.jpg', RedirectView.as_view(url='static/distance/foto_no_exif.jpg'), name='background'),
-    url(r'^compose\.png', RedirectView.as_view(url='static/distance/oie_transparent.png'), name='compose'),
-    url(r'^logo\.png', RedirectView.as_view(url='static/distance/Logo.png'), name='logo'),
-    url(r'^favicon\.png', RedirectView.as_view(url='static/distance/favicon.png'), name='favicon'),
-    url(r'^favicon_apple\.png', RedirectView.as_view(url='static/distance/favicon_apple.png'), name='favicon_apple'),
-    url(r'^menu\.png', RedirectView.as_view(url='static/distance/Menu.png'), name='menu'),
+    # Request timings per view (staff only)
+    url(r'^performance/$', views.performance_stats, name='performance'),
+
+    # Profiles of single requests, taken by adding ?profile=1 (staff only)
+    url(r'^profiles/$', views.profiles, name='profiles'),
+    url(r'^profiles/(?P<name>[\w.-]+\.prof)$', views.profile_detail, name='profile_detail'),
 ]
\ No newline at end of file
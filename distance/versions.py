@@ -0,0 +1,64 @@
+'''versions.py - Version counters kept in Django's cache. A counter is bumped
+whenever the data it covers changes, so anything derived from that data (such
+as an ETag) can be keyed on the counters instead of being invalidated.'''
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import replicas
+
+
+def user_key(user_id):
+    '''The counter for a user's own settings and location.'''
+    return 'version:user:%d' % int(user_id)
+
+def friends_key(user_id):
+    '''The counter for who a user's friends are.'''
+    return 'version:friends:%d' % int(user_id)
+
+def pair_key(user_id, other_id):
+    '''The counter for the messages and images two users share.'''
+    return 'version:pair:%d:%d' % tuple(sorted((int(user_id), int(other_id))))
+
+def is_key(value):
+    return isinstance(value, str) and value.startswith('version:')
+
+def _recent_key(key):
+    # present for REPLICA_PIN_SECONDS after the counter is bumped
+    return 'recent:' + key
+
+def _initial():
+    # counters that were evicted start again from the clock, so that they
+    # never come back at a value they had before
+    return int(time.time() * 1000000)
+
+def get_many(keys):
+    '''Returns the values of the given counters, in order. If any of them
+    was bumped so recently that the read replicas may not have its data yet,
+    the rest of the request reads from the primary, so that nothing behind
+    the new version is cached under it.'''
+    recent_keys = [_recent_key(key) for key in keys] if settings.DATABASE_REPLICAS else []
+    values = cache.get_many(list(keys) + recent_keys)
+    if any(key in values for key in recent_keys):
+        replicas.pin()
+    for key in keys:
+        if key not in values:
+            cache.add(key, _initial(), None)
+            # another process may have added it first
+            values[key] = cache.get(key)
+    return [values[key] for key in keys]
+
+def bump(*keys):
+    '''Bumps the given counters once the current transaction commits, so that
+    a new version is never seen before its data.'''
+    def bump_now():
+        for key in keys:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, _initial(), None)
+        if settings.DATABASE_REPLICAS:
+            cache.set_many(dict((_recent_key(key), True) for key in keys), settings.REPLICA_PIN_SECONDS)
+    transaction.on_commit(bump_now)
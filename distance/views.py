@@ -2,31 +2,33 @@
 
 from django.contrib.auth import login, authenticate
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.http import (FileResponse, Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect,
+    JsonResponse, StreamingHttpResponse)
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.urls import reverse
 from django.conf import settings
-
-from django.db.models import Q
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.utils.cache import patch_cache_control
+from django.utils.functional import SimpleLazyObject
+from django.views.decorators.http import condition
 
 from .forms import SignUpForm, SettingsForm
 from .models import User, Message, Image
+from .search import search_users
+from . import (fragments, friendships, geocoding, imageproxy, inbox, performance, profiling, push, replicas,
+    timezones, versions, weather)
 
 import datetime
-import pytz
-
-from pyowm import OWM
-
-from geopy.geocoders import Nominatim
+import hashlib
+import json
 
 
 
 def index(request):
     '''Displays the home page.'''
     if request.user.is_authenticated:
-        friends_list = request.user.connections.all()
-        num_msgs = Message.objects.filter(receiver=request.user, read=False).count()
-        return render(request, 'distance/index.html', {'friends_list': friends_list, 'num_msgs': num_msgs})
+        return render(request, 'distance/index.html')
     return HttpResponseRedirect(reverse('login'))
 
 def signup(request):
@@ -36,38 +38,17 @@ def signup(request):
         if request.method == 'POST':
             form = SignUpForm(request.POST)
             if form.is_valid():
-                form.save()
+                # the city and country are looked up in the background, so
+                # show that they are being located until then
+                user = form.save(commit=False)
+                user.city = geocoding.LOCATING
+                user.country = ''
+                user.save()
+                geocoding.locate_later(user.pk)
                 username = form.cleaned_data.get('username')
                 raw_password = form.cleaned_data.get('password1')
                 user = authenticate(username=username, password=raw_password)
                 login(request, user)
-                # geopy uses an API that either declares a city name by
-                # village, city, suburb, hamlet, or town based on the city
-                # size. So we must try them all.
-                try:
-                    geolocator = Nominatim()
-                    lat_lng = str(user.lat) + ', ' + str(user.lng)
-                    location = geolocator.reverse(lat_lng)
-                    user.city = location.raw['address']['village']
-                except KeyError:
-                    try:
-                        user.city = location.raw['address']['city']
-                    except KeyError:
-                        try:
-                            user.city = location.raw['address']['suburb']
-                        except KeyError:
-                            try:
-                                user.city = location.raw['address']['hamlet']
-                            except KeyError:
-                                try:
-                                    user.city = location.raw['address']['town']
-                                except KeyError:
-                                    user.city = 'Not Found'
-                try:
-                    user.country = location.raw['address']['country']
-                except KeyError:
-                    user.country = 'Not Found'
-                user.save()
                 return HttpResponseRedirect(reverse('distance:index'))
         else:
             form = SignUpForm()
@@ -76,42 +57,30 @@ def signup(request):
     return HttpResponseRedirect(reverse('distance:index'))
 
 def search_friends(request):
-    '''Searches for Users based on the username searched so that the user can
-    add as a friend.'''
+    '''Searches for Users by username (allowing partial usernames and typos)
+    so that the user can add them as a friend.'''
     if request.user.is_authenticated:
         if request.method == 'GET':
-            search = request.GET.get('search_friends')
-            # If that username exists
-            if User.objects.filter(username=search).count() > 0:
-                # Prevent the user from friending theirself
-                if User.objects.filter(username=search)[0] != request.user:
-                    # Check if they're already friends
-                    if User.objects.filter(username=search)[0] in request.user.connections.all():
-                        already_friends = True
-                    else:
-                        already_friends = False
-                    # Check if the user has already sent the receiver a friend
-                    # request.
-                    if Message.objects.filter(sender=request.user,
-                        receiver=User.objects.filter(username=search)[0],
-                        msg_type=Message.FRIEND_REQUEST).count() > 0:
-                        pending = True
-                    else:
-                        pending = False
-                    friends_list = request.user.connections.all()
-                    num_msgs = Message.objects.filter(receiver=request.user, read=False).count()
+            search = request.GET.get('search_friends', '').strip()
+            if search:
+                paginator = Paginator(search_users(request.user, search), settings.SEARCH_PAGE_SIZE)
+                try:
+                    page = paginator.page(request.GET.get('page', 1))
+                except PageNotAnInteger:
+                    page = paginator.page(1)
+                except EmptyPage:
+                    page = paginator.page(paginator.num_pages)
+                if page.object_list:
                     context = {
                         'search': search,
-                        'already_friends': already_friends,
-                        'pending': pending,
-                        'friends_list': friends_list,
-                        'num_msgs': num_msgs,
+                        'page': page,
                     }
                     return render(request, 'distance/search_results.html', context)
-                else:
+                # Prevent the user from friending theirself
+                if search == request.user.username:
                     messages.add_message(request, messages.INFO, 'That\'s your username!')
-            else:
-                messages.add_message(request, messages.INFO, 'That username does not exist.')
+                    return HttpResponseRedirect(reverse('distance:index'))
+            messages.add_message(request, messages.INFO, 'That username does not exist.')
     else:
         messages.add_message(request, messages.INFO, 'You are not logged in.')
     return HttpResponseRedirect(reverse('distance:index'))
@@ -134,51 +103,104 @@ def add_friend(request):
 def view_messages(request):
     '''Gets all the messages that the user is the receiver of.'''
     if request.user.is_authenticated:
-        msg_list = Message.objects.filter(receiver=request.user)
-        friends_list = request.user.connections.all()
-        for msg in msg_list:
-            msg.read = True
-            msg.save()
-        num_msgs = 0
-        return render(request, 'distance/messages.html', {'msg_list': msg_list, 'friends_list': friends_list, 'num_msgs': num_msgs})
+        msg_list = list(Message.objects.filter(receiver=request.user).select_related('sender'))
+        request.user.unread_count -= Message.mark_read(msg_list)
+        return render(request, 'distance/messages.html', {'msg_list': msg_list})
+    else:
+        messages.add_message(request, messages.INFO, 'You are not logged in.')
+    return HttpResponseRedirect(reverse('distance:index'))
+
+def report_inbox_actions(request, result):
+    '''Tells the user what a batch of inbox actions did.'''
+    accepted = result['accepted']
+    if len(accepted) == 1:
+        messages.add_message(request, messages.INFO, accepted[0] + ' has been added as a friend.')
+    elif accepted:
+        messages.add_message(request, messages.INFO, str(len(accepted)) + ' friends have been added.')
+
+def inbox_action(request):
+    '''Accepts, rejects, deletes, or marks as read any number of the
+    user's messages at once (see inbox.parse_actions for the form).'''
+    if request.user.is_authenticated:
+        if request.method == 'POST':
+            result = inbox.apply_actions(request.user, inbox.parse_actions(request.POST))
+            report_inbox_actions(request, result)
+            return HttpResponseRedirect(reverse('distance:view_messages'))
     else:
         messages.add_message(request, messages.INFO, 'You are not logged in.')
     return HttpResponseRedirect(reverse('distance:index'))
 
 def accept(request):
-    '''Accepts a friend request and makes the two users friends.'''
+    '''Accepts a friend request and makes the two users friends, or deletes
+    a message (rejecting it if it is a friend request).'''
     if request.user.is_authenticated:
         if request.method == 'POST':
-            for msg in Message.objects.filter(receiver=request.user):
-                if request.POST.get(str(msg.id)) == 'Accept':
-                    # add friend request sender to this user's friends
-                    request.user.connections.add(msg.sender)
-                    # add this user to friend request sender's friends
-                    msg.sender.connections.add(request.user)
-                    # save both
-                    request.user.save()
-                    msg.sender.save()
-                    messages.add_message(request, messages.INFO, msg.sender.username + ' has been added as a friend.')
-                    msg.delete()
-                    return HttpResponseRedirect(reverse('distance:view_messages'))
-                # delete message (reject friend request)
-                elif request.POST.get(str(msg.id) + 'X') == 'X':
-                    msg.delete()
-                    return HttpResponseRedirect(reverse('distance:view_messages'))
+            # the pressed button is named after the message id, so look the
+            # message up directly rather than checking every message
+            pairs = []
+            for key, value in request.POST.items():
+                if inbox.message_id(key) is not None and value == 'Accept':
+                    pairs.append((inbox.message_id(key), inbox.ACCEPT))
+                elif inbox.message_id(key[:-1]) is not None and key.endswith('X') and value == 'X':
+                    pairs.append((inbox.message_id(key[:-1]), inbox.DELETE))
+            if pairs:
+                report_inbox_actions(request, inbox.apply_actions(request.user, pairs))
+                return HttpResponseRedirect(reverse('distance:view_messages'))
     else:
         messages.add_message(request, messages.INFO, 'You are not logged in.')
     return HttpResponseRedirect(reverse('distance:index'))
 
+def events(request):
+    '''Streams the user's new messages and unread count changes as
+    Server-Sent Events (see push.py), if PUSH_ENABLED is set.'''
+    if not settings.PUSH_ENABLED:
+        raise Http404
+    if not request.user.is_authenticated:
+        return HttpResponse(status=401)
+    response = StreamingHttpResponse(push.stream(request.user.pk, request.user.unread_count),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # ask proxies such as nginx to pass events on as they are sent
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 def friends(request):
     '''Displays list of friends.'''
     if request.user.is_authenticated:
-        friends_list = request.user.connections.all()
-        num_msgs = Message.objects.filter(receiver=request.user, read=False).count()
-        return render(request, 'distance/friends.html', {'friends_list': friends_list, 'num_msgs': num_msgs})
+        return render(request, 'distance/friends.html')
     else:
         messages.add_message(request, messages.INFO, 'You are not logged in.')
     return HttpResponseRedirect(reverse('distance:index'))
 
+def friend_dashboard(user, friend, observations=None):
+    '''Returns the clocks and weather shown on the friend view of user and
+    friend. The weather is looked up unless observations, the (kelvin,
+    status) observations of user and friend, are given.'''
+    # get the utc offsets for the clocks, along with the
+    # upcoming DST changes so the clocks stay right across them
+    offsets1 = timezones.offset_schedule(user.timezone)
+    offsets2 = timezones.offset_schedule(friend.timezone)
+
+    # get temps and weather (observations are cached per location
+    # cell, and both locations are fetched at the same time)
+    if observations is None:
+        observations = weather.get_observations([
+            (user.lat, user.lng),
+            (friend.lat, friend.lng),
+        ])
+    observation1, observation2 = observations
+    temp1, status1 = weather.describe(observation1, user.temp_unit)
+    temp2, status2 = weather.describe(observation2, user.temp_unit)
+
+    return {
+        'offsets1': offsets1,
+        'offsets2': offsets2,
+        'temp1': temp1,
+        'temp2': temp2,
+        'status1': status1,
+        'status2': status2,
+    }
+
 def friend_view(request, **kwargs):
     '''Displays homepage for a given friend.'''
     if request.user.is_authenticated:
@@ -187,91 +209,36 @@ def friend_view(request, **kwargs):
             # check to make sure that the user is actually friends with this user
             # (because otherwise they could put arbitrary
             # numbers at the end of the url to see other user pages).
-            if request.user.connections.filter(id=friend_id).count() > 0:
-                # get offsets for clocks
-                friend = request.user.connections.filter(id=friend_id)[0]
-
-                # get request.user's utc offset
-                utc_offset1 = datetime.datetime.now(pytz.timezone(request.user.timezone)).strftime('%z')
-                hr_offset1 = int(utc_offset1[:3])
-                # check if utc offset is positive or negative
-                if utc_offset1[:1] == '+':
-                    min_offset1 = int(utc_offset1[3:])
-                else:
-                    min_offset1 = -1 * int(utc_offset1[3:])
-
-                # get friend's utc offset
-                utc_offset2 = datetime.datetime.now(pytz.timezone(friend.timezone)).strftime('%z')
-                hr_offset2 = int(utc_offset2[:3])
-                if utc_offset2[:1] == '+':
-                    min_offset2 = int(utc_offset2[3:])
-                else:
-                    min_offset2 = -1 * int(utc_offset2[3:])
-
-                # get temps and weather
-                owm = OWM(settings.WEATHER_API_KEY)
-
-                # get unit to display temperature in
-                if request.user.temp_unit == 'K':
-                    temp_unit = 'kelvin'
-                    unit = 'K'
-                elif request.user.temp_unit == 'C':
-                    temp_unit = 'celsius'
-                    unit = '°C'
-                else:
-                    temp_unit = 'fahrenheit'
-                    unit = '°F'
-
-                # get temp for user and temp for friend
-                temp1 = str(int(round(owm.weather_at_coords(request.user.lat,
-                    request.user.lng).get_weather().get_temperature(temp_unit)['temp']))) + unit
-                temp2 = str(int(round(owm.weather_at_coords(friend.lat,
-                    friend.lng).get_weather().get_temperature(temp_unit)['temp']))) + unit
-
-                # get weather status for user and for friend
-                status1 = owm.weather_at_coords(request.user.lat, request.user.lng).get_weather().get_detailed_status()
-                status2 = owm.weather_at_coords(friend.lat, friend.lng).get_weather().get_detailed_status()
-
-                # background images
-                images = []
-                for img in Image.objects.all():
-                    if request.user == img.user1 and friend == img.user2 or request.user == img.user2 and friend == img.user1:
-                        images.append(img.image_url)
-
-                friends_list = request.user.connections.all()
+            friend = friendships.get_friend(request.user, friend_id)
+            if friend is not None:
+                context = friend_dashboard(request.user, friend)
 
                 # Since messages can be viewed from the friend view, any message
                 # from friend to user is read when friend view is open.
-                msg_list = Message.objects.filter(receiver=request.user, sender=friend)
-                for msg in msg_list:
-                    msg.read = True
-                    msg.save()
-                num_msgs = Message.objects.filter(receiver=request.user, read=False).count()
-
-                city1 = request.user.city
-                country1 = request.user.country
-                city2 = friend.city
-                country2 = friend.country
-
-                context = {
+                conversation = Message.objects.filter(receiver=request.user, sender=friend)
+                # read from the primary, since a replica may not have the
+                # newest messages yet
+                with replicas.use_primary():
+                    unread = list(conversation.filter(read=False))
+                request.user.unread_count -= Message.mark_read(unread)
+
+                # the images and messages are only fetched if their cached
+                # fragments are out of date (see fragments.py)
+                images = Image.for_pair(request.user, friend).values_list('image_url', flat=True)
+                context.update({
                     'friend': friend,
-                    'hr_offset1': hr_offset1,
-                    'hr_offset2': hr_offset2,
-                    'min_offset1': min_offset1,
-                    'min_offset2': min_offset2,
-                    'temp1': temp1,
-                    'temp2': temp2,
-                    'status1': status1,
-                    'status2': status2,
-                    'images': images,
-                    'friends_list': friends_list,
-                    'num_msgs': num_msgs,
-                    'msg_list': msg_list,
-                    'city1': city1,
-                    'country1': country1,
-                    'city2': city2,
-                    'country2': country2,
-                }
+                    'offsets1': json.dumps(context['offsets1']),
+                    'offsets2': json.dumps(context['offsets2']),
+                    'images': SimpleLazyObject(lambda: list(images)),
+                    'msg_list': SimpleLazyObject(lambda: list(conversation)),
+                    'cursor': conversation.order_by('-pk').values_list('pk', flat=True).first() or 0,
+                    'poll_seconds': settings.PUSH_POLL_SECONDS if settings.PUSH_ENABLED
+                        else settings.FRIEND_POLL_SECONDS,
+                    'city1': request.user.city,
+                    'country1': request.user.country,
+                    'city2': friend.city,
+                    'country2': friend.country,
+                })
 
                 return render(request, 'distance/friend_view.html', context)
             else:
@@ -281,6 +248,81 @@ def friend_view(request, **kwargs):
         messages.add_message(request, messages.INFO, 'You are not logged in.')
     return HttpResponseRedirect(reverse('distance:index'))
 
+def friend_and_weather(request, friend_id):
+    '''Returns the user's friend with id friend_id (None if they are not
+    friends) and the stored weather reports of the user and the friend (see
+    weather.read_latest). They are read once per request, and shared by
+    friend_data_etag and friend_data.'''
+    if not hasattr(request, '_friend_and_weather'):
+        friend = friendships.get_friend(request.user, friend_id)
+        reports = None
+        if friend is not None:
+            reports = weather.read_latest([(request.user.lat, request.user.lng), (friend.lat, friend.lng)])
+        request._friend_and_weather = (friend, reports)
+    return request._friend_and_weather
+
+def friend_data_etag(request, friend_id):
+    '''Returns an ETag for friend_data built from version counters and the
+    times the two weather reports were observed, so that an unchanged poll
+    is answered without reading the images or messages.'''
+    if not request.user.is_authenticated:
+        return None
+    friend, reports = friend_and_weather(request, friend_id)
+    if friend is None:
+        return None
+    counters = versions.get_many([
+        versions.user_key(request.user.pk),
+        versions.user_key(friend.pk),
+        versions.pair_key(request.user.pk, friend.pk),
+    ])
+    observed = [report[2].isoformat() if report else '' for report in reports]
+    # the clock offsets are sent for a year from today, so send them again
+    # each day
+    tag = '%s|%s|%s|%s|%s|%s' % (request.user.pk, friend.pk, request.GET.get('since', ''),
+        datetime.date.today(), '|'.join(str(counter) for counter in counters), '|'.join(observed))
+    return hashlib.md5(tag.encode('utf-8')).hexdigest()
+
+@condition(etag_func=friend_data_etag)
+def friend_data(request, friend_id):
+    '''Returns what the friend view shows as JSON: the clock offsets,
+    weather, background images, and the messages from friend newer than the
+    since message id. Polls with an unchanged ETag get 304 Not Modified.'''
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'You are not logged in.'}, status=401)
+    friend, reports = friend_and_weather(request, friend_id)
+    if friend is None:
+        return JsonResponse({'error': 'You are not friends with this user.'}, status=403)
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        since = 0
+    # the weather sent is the weather the ETag was built from; cells with no
+    # report yet are looked up as usual
+    observations = [report[:2] if report else weather.get_observation(lat, lng) for report, (lat, lng)
+        in zip(reports, [(request.user.lat, request.user.lng), (friend.lat, friend.lng)])]
+    data = friend_dashboard(request.user, friend, observations)
+    data['images'] = list(Image.for_pair(request.user, friend).values_list('image_url', flat=True))
+    msg_list = list(Message.objects.filter(receiver=request.user, sender=friend, pk__gt=since)
+        .order_by('pk')[:settings.FRIEND_DATA_MESSAGES])
+    Message.mark_read(msg_list)
+    data.update({
+        'city1': request.user.city,
+        'country1': request.user.country,
+        'city2': friend.city,
+        'country2': friend.country,
+        'messages': [{
+            'id': msg.id,
+            'sender': friend.username,
+            'content': msg.msg_content,
+            'created_at': msg.created_at.isoformat(),
+        } for msg in msg_list],
+        'cursor': max([msg.id for msg in msg_list] or [since]),
+    })
+    response = JsonResponse(data)
+    # always check with the server, which answers 304 when nothing changed
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 def add_images(request, **kwargs):
     '''Displays add images page for a given friend with all current
     images (able to delete) and a form to add more.'''
@@ -290,19 +332,11 @@ def add_images(request, **kwargs):
             # check to make sure that the user is actually friends with this user
             # (because otherwise they could put arbitrary
             # numbers at the end of the url to see other user pages).
-            if request.user.connections.filter(id=friend_id).count() > 0:
-                friend = request.user.connections.filter(id=friend_id)[0]
-                friends_list = request.user.connections.all()
-                num_msgs = Message.objects.filter(receiver=request.user, read=False).count()
+            friend = friendships.get_friend(request.user, friend_id)
+            if friend is not None:
                 # background images
-                images = []
-                for img in Image.objects.all():
-                    if request.user == img.user1 and friend == img.user2 \
-                        or request.user == img.user2 and friend == img.user1:
-                        images.append(img.image_url)
+                images = list(Image.for_pair(request.user, friend).values_list('image_url', flat=True))
                 context = {'friend': friend,
-                    'friends_list': friends_list,
-                    'num_msgs': num_msgs,
                     'images': images}
                 return render(request, 'distance/add_images.html', context)
             else:
@@ -320,8 +354,8 @@ def image_confirm(request, **kwargs):
                 # check to make sure that the user is actually friends with this user
                 # (because otherwise they could put arbitrary
                 # numbers at the end of the url to see other user pages.
-                if request.user.connections.filter(id=friend_id).count() > 0:
-                    friend = request.user.connections.filter(id=friend_id)[0]
+                friend = friendships.get_friend(request.user, friend_id)
+                if friend is not None:
                     image_url = request.POST.get('image_url')
                     image = Image(user1=request.user, user2=friend, image_url=image_url)
                     image.save()
@@ -334,6 +368,30 @@ def image_confirm(request, **kwargs):
         messages.add_message(request, messages.INFO, 'You are not logged in.')
     return HttpResponseRedirect(reverse('distance:index'))
 
+def proxied_image(request, token, width, image_format):
+    '''Serves a background image resized to width, through the image proxy.
+    If the image cannot be fetched or read, the browser is sent to the
+    original instead.'''
+    url = imageproxy.unsign(token)
+    width = int(width)
+    if url is None or width not in settings.PROXY_IMAGE_WIDTHS:
+        raise Http404('No such image.')
+    try:
+        name, content_type, content = imageproxy.variant(url, width, image_format)
+    except imageproxy.ProxyError:
+        response = HttpResponseRedirect(url)
+        # try the proxy again in a few minutes
+        patch_cache_control(response, max_age=300)
+        return response
+    etag = '"%s"' % name
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.PROXY_IMAGE_MAX_AGE)
+    return response
+
 def send_msg(request, **kwargs):
     '''Sends a message between a user and a friend.'''
     if request.user.is_authenticated:
@@ -343,14 +401,17 @@ def send_msg(request, **kwargs):
                 # check to make sure that the user is actually friends with this user
                 # (because otherwise they could put arbitrary
                 # numbers at the end of the url to see other user pages).
-                if request.user.connections.filter(id=friend_id).count() > 0:
-                    friend = request.user.connections.filter(id=friend_id)[0]
-
-                    # delete message from friend page
-                    for msg in Message.objects.filter(receiver=request.user, sender=friend):
-                        if request.POST.get(str(msg.id) + 'FX') == 'X':
-                            msg.delete()
-                            return HttpResponseRedirect(reverse('distance:friend_view', args=(msg.sender.id,)))
+                friend = friendships.get_friend(request.user, friend_id)
+                if friend is not None:
+
+                    # delete message from friend page (the pressed button is
+                    # named after the message id)
+                    for key, value in request.POST.items():
+                        if key.endswith('FX') and inbox.message_id(key[:-2]) is not None and value == 'X':
+                            msg = Message.objects.filter(pk=inbox.message_id(key[:-2]), receiver=request.user, sender=friend).first()
+                            if msg is not None:
+                                msg.delete()
+                            return HttpResponseRedirect(reverse('distance:friend_view', args=(friend.id,)))
 
                     # send message from friend page
                     msg_content = request.POST.get('msg')
@@ -365,9 +426,9 @@ def send_msg(request, **kwargs):
             else:
                 # send message from messages page
                 receiver = request.POST.get('receiver')
-                if User.objects.filter(username=receiver).count() > 0:
-                    if User.objects.filter(username=receiver)[0] in request.user.connections.all():
-                        receiver_user = User.objects.filter(username=receiver)[0]
+                receiver_user = User.objects.filter(username=receiver).first()
+                if receiver_user is not None:
+                    if friendships.is_friend(request.user, receiver_user.id):
                         msg_content = request.POST.get('msg')
                         dt = datetime.datetime.now()
                         msg = Message(sender=request.user, receiver=receiver_user, msg_content=msg_content, created_at=dt, msg_type=Message.NORMAL_MESSAGE)
@@ -391,9 +452,9 @@ def del_img(request, **kwargs):
                 # check to make sure that the user is actually friends with this
                 # user (because otherwise they could put arbitrary
                 # numbers at the end of the url to see other user pages).
-                if request.user.connections.filter(id=friend_id).count() > 0:
-                    friend = request.user.connections.filter(id=friend_id)[0]
-                    img_list = Image.objects.filter(Q(user1=request.user, user2=friend) | Q(user1=friend, user2=request.user))
+                friend = friendships.get_friend(request.user, friend_id)
+                if friend is not None:
+                    img_list = Image.for_pair(request.user, friend)
                     for img in img_list:
                         if request.POST.get(img.image_url) == 'X':
                             img.delete()
@@ -428,9 +489,6 @@ def settings_view(request):
         temp_unit = request.user.temp_unit
         city = request.user.city
         country = request.user.country
-
-        friends_list = request.user.connections.all()
-        num_msgs = Message.objects.filter(receiver=request.user, read=False).count()
         data = {
             'timezone': timezone,
             'lat': lat,
@@ -442,8 +500,6 @@ def settings_view(request):
         form = SettingsForm(initial=data)
         context = {
             'form': form,
-            'friends_list': friends_list,
-            'num_msgs': num_msgs,
         }
         return render(request, 'distance/settings_view.html', context)
     else:
@@ -471,4 +527,43 @@ def settings_set(request):
             return HttpResponseRedirect(reverse('distance:settings_view'))
     else:
         messages.add_message(request, messages.INFO, 'You are not logged in.')
-    return HttpResponseRedirect(reverse('distance:index'))
\ No newline at end of file
+    return HttpResponseRedirect(reverse('distance:index'))
+
+@staff_member_required
+def performance_stats(request):
+    '''Shows staff the request count, mean timings, and duration histogram
+    of every view, and the hits and misses of every cached template
+    fragment, since the server started (or since they were reset with a
+    POST).'''
+    if request.method == 'POST':
+        performance.reset()
+        fragments.reset()
+    return JsonResponse({
+        'views': performance.snapshot(),
+        'fragments': fragments.snapshot(),
+    })
+
+@staff_member_required
+def profiles(request):
+    '''Lists the saved request profiles (see profiling.py).'''
+    return render(request, 'distance/profiles.html', {'profiles': profiling.list_profiles()})
+
+@staff_member_required
+def profile_detail(request, name):
+    '''Shows the slowest functions in a saved profile, or downloads it (for
+    tools such as snakeviz) with ?download=1.'''
+    path = profiling.path_for(name)
+    if path is None:
+        raise Http404('No such profile.')
+    if request.GET.get('download') == '1':
+        response = FileResponse(open(path, 'rb'), content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % name
+        return response
+    sort = request.GET.get('sort', 'cumulative')
+    context = {
+        'name': name,
+        'sort': sort,
+        'sort_keys': profiling.SORT_KEYS,
+        'summary': profiling.summarize(path, sort),
+    }
+    return render(request, 'distance/profile_detail.html', context)
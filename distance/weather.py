@@ -0,0 +1,285 @@
+'''weather.py - Caches OpenWeatherMap observations by location cell so that
+users who live near each other share one upstream lookup. Observations are
+refreshed in bulk by the refresh_weather command and read from the
+WeatherReport table by pages.'''
+from collections import OrderedDict
+from concurrent import futures
+import json
+import math
+import threading
+import time
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Case, CharField, FloatField, Q, Value, When
+from django.utils import timezone
+
+from . import performance
+from .models import WeatherReport
+
+
+class WeatherCache:
+    '''A thread-safe LRU cache of observations keyed by location cell. Each
+    entry is stored in a unit-neutral form (temperature in Kelvin and the
+    detailed status) and expires after ttl seconds.'''
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cell):
+        '''Returns the (kelvin, status) observation for a cell, or None if it
+        is missing or has expired.'''
+        with self._lock:
+            entry = self._entries.get(cell)
+            if entry is None:
+                return None
+            expires, observation = entry
+            if expires < time.monotonic():
+                del self._entries[cell]
+                return None
+            self._entries.move_to_end(cell)
+            return observation
+
+    def set(self, cell, observation):
+        '''Stores an observation for a cell, evicting the least recently used
+        cells once the cache is full.'''
+        with self._lock:
+            self._entries[cell] = (time.monotonic() + self.ttl, observation)
+            self._entries.move_to_end(cell)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# store_reports reads and writes this many cells per query, which keeps its
+# queries under SQLite's limit of 999 parameters
+STORE_BATCH_SIZE = 100
+
+cache = WeatherCache(settings.WEATHER_CACHE_TTL, settings.WEATHER_CACHE_SIZE)
+
+# upstream lookups run in a bounded pool so that a page can fetch several
+# locations at once without spawning unbounded threads
+_executor = futures.ThreadPoolExecutor(max_workers=settings.WEATHER_FETCH_WORKERS)
+# lookups that are currently running, so that concurrent requests for the same
+# cell wait on one fetch instead of starting their own
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def cell_for(lat, lng):
+    '''Rounds coordinates to the cell they are cached under.'''
+    digits = settings.WEATHER_CELL_DIGITS
+    return (round(float(lat), digits), round(float(lng), digits))
+
+def _get_json(path, params, api_url=None):
+    params = dict(params, appid=settings.WEATHER_API_KEY)
+    url = (api_url or settings.WEATHER_API_URL) + path + '?' + urlencode(params)
+    with performance.timed('external'):
+        with urlopen(url, timeout=settings.WEATHER_FETCH_TIMEOUT) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+def _parse(data):
+    return (data['main']['temp'], data['weather'][0]['description'])
+
+def fetch_observation(cell, api_url=None):
+    '''Asks OpenWeatherMap for the weather at the center of a cell. Only one
+    request is made, and both the temperature and status come from it.'''
+    return _parse(_get_json('/weather', {'lat': cell[0], 'lon': cell[1]}, api_url))
+
+def fetch_box(lat_bottom, lng_left, lat_top, lng_right, api_url=None):
+    '''Asks OpenWeatherMap for the weather at every city inside a bounding
+    box with a single request. Returns a list of (lat, lng, observation).'''
+    bbox = '%s,%s,%s,%s,%s' % (lng_left, lat_bottom, lng_right, lat_top,
+        settings.WEATHER_BATCH_ZOOM)
+    data = _get_json('/box/city', {'bbox': bbox, 'units': 'standard'}, api_url)
+    cities = []
+    for city in data.get('list', []):
+        # the box endpoint capitalizes its coordinate keys
+        coord = {key.lower(): value for key, value in city['coord'].items()}
+        cities.append((coord['lat'], coord['lon'], _parse(city)))
+    return cities
+
+def _cells_query(cells):
+    query = Q()
+    for lat, lng in cells:
+        query |= Q(lat=lat, lng=lng)
+    return query
+
+def read_reports(cells):
+    '''Returns the stored observations for the given cells as a dict keyed
+    by cell, in one query.'''
+    if not cells:
+        return {}
+    return {(report.lat, report.lng): (report.kelvin, report.status)
+        for report in WeatherReport.objects.filter(_cells_query(cells))}
+
+def read_latest(locations):
+    '''Returns the stored (kelvin, status, observed_at) report for each
+    (lat, lng) in locations, or None where there is none, in one query.
+    Unlike get_observations, this always reads the WeatherReport table, so
+    that the reports are as new as their observed_at says.'''
+    cells = [cell_for(lat, lng) for lat, lng in locations]
+    reports = {(lat, lng): (kelvin, status, observed_at) for lat, lng, kelvin, status, observed_at in
+        WeatherReport.objects.filter(_cells_query(set(cells)))
+        .values_list('lat', 'lng', 'kelvin', 'status', 'observed_at')}
+    for cell, report in reports.items():
+        cache.set(cell, report[:2])
+    return [reports.get(cell) for cell in cells]
+
+def group_cells(cells):
+    '''Groups cells into squares WEATHER_BATCH_DEGREES wide so that each
+    group can be refreshed with one bounding box request.'''
+    size = settings.WEATHER_BATCH_DEGREES
+    groups = {}
+    for cell in cells:
+        key = (math.floor(cell[0] / size), math.floor(cell[1] / size))
+        groups.setdefault(key, []).append(cell)
+    return list(groups.values())
+
+def refresh_cells(cells, api_url=None):
+    '''Fetches fresh observations for the given cells, one bounding box
+    request per group of nearby cells. A cell gets the observation of the
+    nearest city in its box, or its own request if no city in the box is
+    within WEATHER_BATCH_MATCH_DEGREES. Returns the observations keyed by
+    cell, the number of upstream requests made, and the number that
+    failed.'''
+    match = settings.WEATHER_BATCH_MATCH_DEGREES
+    observations = {}
+    requests = 0
+    failures = 0
+    for group in group_cells(cells):
+        lats = [cell[0] for cell in group]
+        lngs = [cell[1] for cell in group]
+        requests += 1
+        try:
+            cities = fetch_box(min(lats) - match, min(lngs) - match,
+                max(lats) + match, max(lngs) + match, api_url)
+        except (OSError, ValueError, KeyError, IndexError):
+            failures += 1
+            cities = []
+        for cell in group:
+            nearest = None
+            nearest_distance = match
+            for lat, lng, observation in cities:
+                distance = max(abs(lat - cell[0]), abs(lng - cell[1]))
+                if distance <= nearest_distance:
+                    nearest, nearest_distance = observation, distance
+            if nearest is None:
+                requests += 1
+                try:
+                    nearest = fetch_observation(cell, api_url)
+                except (OSError, ValueError, KeyError, IndexError):
+                    failures += 1
+                    continue
+            observations[cell] = nearest
+    return observations, requests, failures
+
+@transaction.atomic
+def store_reports(observations, observed_at):
+    '''Saves observations to the WeatherReport table, STORE_BATCH_SIZE cells
+    at a time. Each batch looks up which of its cells already have a report,
+    updates those with one UPDATE, and inserts the rest in bulk, so only the
+    cells that were fetched are read or written.'''
+    cells = list(observations)
+    for start in range(0, len(cells), STORE_BATCH_SIZE):
+        batch = cells[start:start + STORE_BATCH_SIZE]
+        existing = {(lat, lng): pk for pk, lat, lng in WeatherReport.objects
+            .filter(_cells_query(batch)).values_list('pk', 'lat', 'lng')}
+        if existing:
+            kelvins = [When(pk=pk, then=Value(observations[cell][0])) for cell, pk in existing.items()]
+            statuses = [When(pk=pk, then=Value(observations[cell][1])) for cell, pk in existing.items()]
+            WeatherReport.objects.filter(pk__in=existing.values()).update(
+                kelvin=Case(*kelvins, output_field=FloatField()),
+                status=Case(*statuses, output_field=CharField()),
+                observed_at=observed_at)
+        WeatherReport.objects.bulk_create([WeatherReport(lat=cell[0], lng=cell[1],
+            kelvin=observations[cell][0], status=observations[cell][1], observed_at=observed_at)
+            for cell in batch if cell not in existing])
+
+def _fetch_and_cache(cell):
+    try:
+        observation = fetch_observation(cell)
+        cache.set(cell, observation)
+        # stored as well, so that other processes, and the friend_data ETag
+        # (which is built from the reports' times), see it too
+        try:
+            store_reports({cell: observation}, timezone.now())
+        except DatabaseError:
+            # another process stored the cell first
+            pass
+        finally:
+            # this runs on the pool's threads, which Django does not close
+            # connections for
+            connections.close_all()
+        return observation
+    finally:
+        with _in_flight_lock:
+            del _in_flight[cell]
+
+def _submit(cell):
+    with _in_flight_lock:
+        future = _in_flight.get(cell)
+        if future is None:
+            future = _executor.submit(_fetch_and_cache, cell)
+            _in_flight[cell] = future
+        return future
+
+def get_observations(locations):
+    '''Returns a (kelvin, status) observation for each (lat, lng) in
+    locations, or None where there is none. Cells that are not cached in
+    memory are read from the WeatherReport table. If WEATHER_FETCH_ON_MISS is
+    set, cells that have never been refreshed are then fetched upstream once
+    each, all at the same time, and waited on for at most
+    WEATHER_FETCH_TIMEOUT seconds.'''
+    cells = [cell_for(lat, lng) for lat, lng in locations]
+    observations = {}
+    missing = []
+    for cell in cells:
+        if cell in observations or cell in missing:
+            continue
+        observation = cache.get(cell)
+        if observation is None:
+            missing.append(cell)
+        else:
+            observations[cell] = observation
+    for cell, observation in read_reports(missing).items():
+        cache.set(cell, observation)
+        observations[cell] = observation
+    if settings.WEATHER_FETCH_ON_MISS:
+        pending = {cell: _submit(cell) for cell in missing if cell not in observations}
+        if pending:
+            # the fetches run on the pool's threads, so time the wait here
+            with performance.timed('external'):
+                futures.wait(pending.values(), timeout=settings.WEATHER_FETCH_TIMEOUT)
+            for cell, future in pending.items():
+                if future.done() and future.exception() is None:
+                    observations[cell] = future.result()
+    return [observations.get(cell) for cell in cells]
+
+def get_observation(lat, lng):
+    '''Returns the (kelvin, status) observation at the given coordinates, or
+    None if it could not be fetched in time.'''
+    return get_observations([(lat, lng)])[0]
+
+def format_temperature(kelvin, temp_unit):
+    '''Converts a temperature in Kelvin to the user's temperature unit and
+    formats it for display.'''
+    if temp_unit == 'C':
+        return str(int(round(kelvin - 273.15))) + '°C'
+    elif temp_unit == 'F':
+        return str(int(round(kelvin * 9 / 5 - 459.67))) + '°F'
+    return str(int(round(kelvin))) + 'K'
+
+def describe(observation, temp_unit):
+    '''Returns the (temperature, status) strings shown for an observation.'''
+    if observation is None:
+        return ('', 'Weather unavailable')
+    kelvin, status = observation
+    return (format_temperature(kelvin, temp_unit), status)
@@ -35,6 +35,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'distance.performance.PerformanceMiddleware',
+    'distance.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -42,13 +44,14 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'distance.profiling.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'mysite.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'distance.performance.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -57,6 +60,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'distance.context_processors.sidebar',
             ],
         },
     },
@@ -75,6 +79,42 @@ DATABASES = {
         'USER': '[Insert database user here]',
         'PASSWORD': '[Insert database password here]',
         'HOST': 'hereandthere.mysql.pythonanywhere-services.com',
+        # keep connections open between requests for up to a minute
+        'CONN_MAX_AGE': 60,
+    }
+}
+
+# read replicas of the default database, by alias; reads are spread over the
+# healthy ones (see distance/replicas.py). For example:
+#
+#     DATABASES['replica1'] = dict(DATABASES['default'], HOST='...',
+#         TEST={'MIRROR': 'default'})
+#     DATABASE_REPLICAS = ['replica1']
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['distance.replicas.ReplicaRouter']
+# browsers read from the default database for REPLICA_PIN_SECONDS after they
+# write, which should be longer than the replicas are usually behind
+REPLICA_PIN_SECONDS = 5
+# replicas are checked every REPLICA_HEALTH_CHECK_SECONDS and skipped while
+# they are down or (on MySQL, which needs the REPLICATION CLIENT privilege)
+# over REPLICA_MAX_LAG_SECONDS behind; None skips the lag check
+REPLICA_HEALTH_CHECK_SECONDS = 10
+REPLICA_MAX_LAG_SECONDS = 30
+# persistent connections idle for longer than this are checked before use
+CONN_HEALTH_CHECK_SECONDS = 30
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+
+# sessions, version counters (see distance/versions.py), and the template
+# fragments keyed on them are kept in memcached, so that a change made
+# through one process is seen by every other. This needs memcached running at LOCATION
+# and the python-memcached package.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
     }
 }
 
@@ -118,6 +158,30 @@ USE_TZ = True
 STATIC_ROOT = u'/home/hereandthere/mysite/static'
 STATIC_URL = '/static/'
 
+# collectstatic names files after a hash of their contents and writes
+# compressed copies of them (see distance/staticfiles.py)
+STATICFILES_STORAGE = 'distance.staticfiles.CompressedManifestStaticFilesStorage'
+
+# images over STATIC_IMAGE_MAX_BYTES are saved again without their metadata,
+# at most STATIC_IMAGE_MAX_SIZE pixels wide and high (needs Pillow)
+STATIC_IMAGE_MAX_BYTES = 200 * 1024
+STATIC_IMAGE_MAX_SIZE = 1920
+STATIC_JPEG_QUALITY = 80
+
+# static files with hashed names never change, so browsers may keep them for
+# a year. SERVE_STATIC serves STATIC_ROOT from Django, for when the web
+# server does not.
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+SERVE_STATIC = True
+
+# sessions are read from the cache (memcached, see CACHES, so that a logout
+# in one process ends the session in all of them) and only fall back to the
+# database when they are not cached, and messages are kept in a signed
+# cookie instead of the session, so a redirect with a message does not write
+# the session (see the bench_sessions command)
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
 # use the modified user model instead of default django model
 AUTH_USER_MODEL = 'distance.User'
 
@@ -137,3 +201,99 @@ EMAIL_USE_TLS = True
 SECURE_SSL_REDIRECT = True
 
 WEATHER_API_KEY = '[Insert OpenWeatherMap API Key here]'
+
+# weather observations are cached per location cell (coordinates rounded to
+# WEATHER_CELL_DIGITS decimal places) for WEATHER_CACHE_TTL seconds
+WEATHER_CELL_DIGITS = 1
+WEATHER_CACHE_TTL = 600
+WEATHER_CACHE_SIZE = 1024
+# uncached locations are fetched concurrently, each waited on for at most
+# WEATHER_FETCH_TIMEOUT seconds
+WEATHER_FETCH_WORKERS = 8
+WEATHER_FETCH_TIMEOUT = 3
+
+# pages only read weather stored by the refresh_weather command; set
+# WEATHER_FETCH_ON_MISS to fetch cells it has not refreshed yet upstream
+WEATHER_API_URL = 'https://api.openweathermap.org/data/2.5'
+WEATHER_FETCH_ON_MISS = False
+# refresh_weather fetches nearby cells with one bounding box request per
+# square of WEATHER_BATCH_DEGREES, matching each cell to the nearest city
+# within WEATHER_BATCH_MATCH_DEGREES
+WEATHER_BATCH_DEGREES = 2
+WEATHER_BATCH_MATCH_DEGREES = 0.25
+WEATHER_BATCH_ZOOM = 10
+
+# reverse geocoding results are cached per location cell (coordinates rounded
+# to GEOCODE_CELL_DIGITS decimal places) for GEOCODE_CACHE_TTL seconds
+GEOCODE_CELL_DIGITS = 2
+GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60
+# 'nominatim' looks places up online at NOMINATIM_URL; 'offline' uses a local
+# GeoNames gazetteer (see README) and reports places within GAZETTEER_MAX_KM
+GEOCODER = 'nominatim'
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org'
+GAZETTEER_PATH = os.path.join(BASE_DIR, 'gazetteer', 'cities1000.txt')
+GAZETTEER_COUNTRIES_PATH = os.path.join(BASE_DIR, 'gazetteer', 'countryInfo.txt')
+GAZETTEER_MAX_KM = 50
+
+# friend pages are sent each clock's DST changes for the next TZ_SCHEDULE_DAYS
+TZ_SCHEDULE_DAYS = 366
+
+# the friend search shows SEARCH_PAGE_SIZE users per page, including users
+# sharing at least SEARCH_MIN_SIMILARITY of the search's trigrams
+SEARCH_PAGE_SIZE = 10
+SEARCH_MIN_SIMILARITY = 0.3
+
+# each user's friend ids are cached for FRIENDS_CACHE_TTL seconds and dropped
+# when their connections change
+FRIENDS_CACHE_TTL = 60 * 60
+
+# responses to staff, and every response when DEBUG is on, report their query
+# count and their time spent in the database, external services, and templates
+# in a Server-Timing header; SERVER_TIMING sends it to every visitor (staff can
+# see the totals per view at /performance/)
+SERVER_TIMING = False
+
+# staff can profile a request by adding ?profile=1 to its url; the newest
+# PROFILE_KEEP profiles are kept in PROFILE_DIR and listed at /profiles/
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILE_KEEP = 50
+
+# friend pages poll for new messages and weather every FRIEND_POLL_SECONDS
+# (PUSH_POLL_SECONDS, just for the weather, when messages are pushed),
+# getting at most FRIEND_DATA_MESSAGES new messages at a time
+FRIEND_POLL_SECONDS = 30
+PUSH_POLL_SECONDS = 600
+FRIEND_DATA_MESSAGES = 50
+
+# with PUSH_ENABLED, new messages and unread counts are pushed to browsers
+# over Server-Sent Events through PUSH_CHANNEL_LAYER (the default only
+# reaches browsers connected to the same process). Every open page holds a
+# worker for as long as its stream is open, so only turn it on when /events/
+# is served by a server that does not need a worker per connection (see
+# README). Each stream gets a comment every PUSH_KEEPALIVE_SECONDS and is
+# ended after PUSH_STREAM_SECONDS, after which the browser reconnects;
+# listeners more than PUSH_QUEUE_SIZE events behind miss events.
+PUSH_ENABLED = False
+PUSH_CHANNEL_LAYER = 'distance.push.InMemoryChannelLayer'
+PUSH_KEEPALIVE_SECONDS = 15
+PUSH_STREAM_SECONDS = 300
+PUSH_QUEUE_SIZE = 100
+
+# rendered template fragments are cached for up to FRAGMENT_CACHE_TTL seconds
+# (a change to what they show makes them miss sooner)
+FRAGMENT_CACHE_TTL = 24 * 60 * 60
+
+# background images are fetched once by the image proxy and kept, resized to
+# each of PROXY_IMAGE_WIDTHS, in a disk cache of at most PROXY_CACHE_MAX_BYTES
+# (see distance/imageproxy.py). Resizing needs Pillow.
+PROXY_CACHE_DIR = os.path.join(BASE_DIR, 'image_cache')
+PROXY_CACHE_MAX_BYTES = 500 * 1024 * 1024
+PROXY_IMAGE_WIDTHS = (160, 480, 960, 1440, 1920)
+PROXY_IMAGE_QUALITY = 80
+PROXY_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+PROXY_IMAGE_TIMEOUT = 10
+PROXY_IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+# only images on public addresses are fetched, unless this is set (for local
+# stand-ins), following at most PROXY_IMAGE_MAX_REDIRECTS redirects
+PROXY_IMAGE_ALLOW_PRIVATE = False
+PROXY_IMAGE_MAX_REDIRECTS = 3
@@ -1,10 +1,13 @@
 """ hereandthere url configuration for administrative urls (having to do with
 admin site or users/passwords
 """
+from django.conf import settings
 from django.conf.urls import include, url
 from django.contrib import admin
 from django.contrib.auth import views as auth_views
 
+from distance import staticfiles
+
 urlpatterns = [
     url(r'^', include('distance.urls', namespace="distance")),
     url(r'^admin/', admin.site.urls),
@@ -20,3 +23,7 @@ urlpatterns = [
         auth_views.password_reset_confirm, name='password_reset_confirm'),
     url(r'^reset/done/$', auth_views.password_reset_complete, name='password_reset_complete'),
 ]
+
+# static files, for when the web server is not set up to serve STATIC_ROOT
+if settings.SERVE_STATIC:
+    urlpatterns.append(url(r'^%s(?P<path>.+)$' % settings.STATIC_URL.lstrip('/'), staticfiles.serve))